@@ -7,6 +7,7 @@ import webapp2_extras.routes
 import apps
 import core
 import jobs
+import ingests
 import users
 import projects
 import sessions
@@ -19,6 +20,8 @@ routes = [
     webapp2_extras.routes.PathPrefixRoute(r'/api', [
         webapp2.Route(r'/download',                                 core.Core, handler_method='download', methods=['GET', 'POST'], name='download'),
         webapp2.Route(r'/upload',                                   core.Core, handler_method='upload', methods=['POST']),
+        webapp2.Route(r'/upload/resumable',                         core.Core, handler_method='resumable_start', methods=['POST']),
+        webapp2.Route(r'/upload/resumable/<:[^/]+>',                core.Core, handler_method='resumable', methods=['GET', 'PUT', 'POST']),
         webapp2.Route(r'/sites',                                    core.Core, handler_method='sites', methods=['GET']),
         webapp2.Route(r'/search',                                   core.Core, handler_method='search', methods=['GET', 'POST']),
     ]),
@@ -76,16 +79,22 @@ routes = [
         webapp2.Route(r'/<:[0-9a-f]{24}>/file',                     acquisitions.Acquisition, handler_method='file', methods=['PUT']),
         webapp2.Route(r'/<:[0-9a-f]{24}>/file/<:[^/]+>',            acquisitions.Acquisition, handler_method='file'),
         webapp2.Route(r'/<:[0-9a-f]{24}>/tile',                     acquisitions.Acquisition, handler_method='get_tile', methods=['GET']),
+        webapp2.Route(r'/<:[0-9a-f]{24}>/tiles',                    acquisitions.Acquisition, handler_method='get_tiles', methods=['POST']),
     ]),
+    webapp2.Route(r'/api/ingests',                                  ingests.Ingests, methods=['GET', 'POST']),
+    webapp2.Route(r'/api/ingests/<:[^/]+>',                         ingests.Ingest, name='ingest', methods=['GET']),
     webapp2.Route(r'/api/jobs',                                     jobs.Jobs),
     webapp2_extras.routes.PathPrefixRoute(r'/api/jobs', [
         webapp2.Route(r'/next',                                     jobs.Jobs, handler_method='next', methods=['GET']),
         webapp2.Route(r'/count',                                    jobs.Jobs, handler_method='count', methods=['GET']),
+        webapp2.Route(r'/counts',                                   jobs.Jobs, handler_method='counts', methods=['GET']),
+        webapp2.Route(r'/latency',                                  jobs.Jobs, handler_method='latency', methods=['GET']),
         webapp2.Route(r'/<:[^/]+>',                                 jobs.Job,  name='job'),
     ]),
     webapp2.Route(r'/api/apps',                                     apps.Apps),
     webapp2_extras.routes.PathPrefixRoute(r'/api/apps', [
         webapp2.Route(r'/count',                                    apps.Apps, handler_method='count', methods=['GET']),
+        webapp2.Route(r'/blobs/<:[0-9a-f]{40}>',                    apps.App,  handler_method='get_blob', methods=['GET']),
         webapp2.Route(r'/<:[^/]+>',                                 apps.App,  name='job'),
         webapp2.Route(r'/<:[^/]+>/file',                            apps.App,  handler_method='get_file'),
     ]),
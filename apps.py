@@ -55,6 +55,22 @@ APP_SCHEMA = {
     'additionalProperties': True
 }
 
+class _TeeReader(object):
+
+    """File-like object that hashes and copies what is read from a stream."""
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.hash = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self.src.read(size)
+        self.hash.update(data)
+        self.dst.write(data)
+        return data
+
+
 # TODO: apps should be stored separately from the datasets
 # possible in something similar to 'quarantine', or at a whole different
 # location.  this should also be configurable.
@@ -86,28 +102,27 @@ class Apps(base.RequestHandler):
 
         app_meta = None
         with tempfile.TemporaryDirectory(prefix='.tmp', dir=apps_path) as tempdir_path:
-            hash_ = hashlib.sha1()
             app_temp = os.path.join(tempdir_path, 'temp')
             with open(app_temp, 'wb') as fd:
-                for chunk in iter(lambda: self.request.body_file.read(2**20), ''):
-                    hash_.update(chunk)
-                    fd.write(chunk)
-            if hash_.hexdigest() != self.request.headers['Content-MD5']:
+                stream = _TeeReader(self.request.body_file, fd)
+                try:
+                    with tarfile.open(fileobj=stream, mode='r|*') as tf:
+                        for ti in tf:
+                            if app_meta is None and ti.name.endswith('description.json'):
+                                try:
+                                    app_meta = json.load(tf.extractfile(ti))
+                                    jsonschema.validate(app_meta, APP_SCHEMA)
+                                except (ValueError, jsonschema.ValidationError) as e:
+                                    self.abort(400, str(e))
+                except tarfile.TarError:
+                    self.abort(415, 'Only tar files are accepted.')
+                for chunk in iter(lambda: stream.read(2**20), ''): # end-of-archive padding
+                    pass
+            if stream.hash.hexdigest() != self.request.headers['Content-MD5']:
                 self.abort(400, 'Content-MD5 mismatch.')  # sha1
-            if not tarfile.is_tarfile(app_temp):
-                self.abort(415, 'Only tar files are accepted.')
-            with tarfile.open(app_temp) as tf:
-                for ti in tf:
-                    if ti.name.endswith('description.json'):
-                        app_meta = json.load(tf.extractfile(ti))
-                        break
             if not app_meta:
                 self.abort(415, 'application tar does not contain description.json')
-            try:
-                jsonschema.validate(app_meta, APP_SCHEMA)
-            except (ValueError, jsonschema.ValidationError) as e:
-                self.abort(400, str(e))
-            util.insert_app(self.app.db, app_temp, apps_path, app_meta=app_meta)  # pass meta info, prevent re-reading
+            util.insert_app(self.app.db, app_temp, apps_path, app_meta=app_meta, sha1=stream.hash.hexdigest())  # pass meta info, prevent re-reading
             log.debug('Recieved App: %s' % app_meta.get('_id'))
 
 
@@ -121,15 +136,58 @@ class App(base.RequestHandler):
         return self.app.db.apps.find_one({'_id': _id})
 
     def get_file(self, _id):
+        """
+        Return the app tar.
+
+        Supports If-None-Match and single byte ranges. Responses must be revalidated;
+        the immutable copy is at the hash-addressed URL in Content-Location.
+        """
         apps_path = self.app.config.get('apps_path')
         if not apps_path:
             self.abort(503, 'GET api/apps/<id> unavailable. apps_path not defined')
         if self.public_request:  # this will most often be a drone request
             self.abort(403, 'must be logged in to download apps')
-        name, version = _id.split(':')
+        app = self.app.db.apps.find_one({'_id': _id}, ['sha1'])
+        if not app:
+            self.abort(404, 'no such app')
+        self._send_tar(app, apps_path, 'no-cache')
+
+    def get_blob(self, sha1):
+        """Return the app tar with the given SHA-1; it never changes, so it may be cached indefinitely."""
+        apps_path = self.app.config.get('apps_path')
+        if not apps_path:
+            self.abort(503, 'GET api/apps/blobs/<sha1> unavailable. apps_path not defined')
+        if self.public_request:
+            self.abort(403, 'must be logged in to download apps')
+        app = self.app.db.apps.find_one({'sha1': sha1}, ['sha1'])
+        if not app:
+            self.abort(404, 'no such app')
+        self._send_tar(app, apps_path, 'private, max-age=31536000, immutable')
+
+    def _send_tar(self, app, apps_path, cache_control):
+        name, version = app['_id'].split(':')
         fn = '%s-%s.tar' % (name, version)
         fp = os.path.join(apps_path, name, fn)
-        self.response.app_iter = open(fp, 'rb')
-        self.response.headers['Content-Length'] = str(os.path.getsize(fp))  # must be set after setting app_iter
+        if not app.get('sha1'): # inserted before apps were hashed
+            app['sha1'] = util.hash_file(fp)
+            self.app.db.apps.update_one({'_id': app['_id']}, {'$set': {'sha1': app['sha1']}})
+        size = os.path.getsize(fp)
+        self.response.headers['ETag'] = '"%s"' % app['sha1']
+        self.response.headers['Cache-Control'] = cache_control
+        self.response.headers['Content-Location'] = '/api/apps/blobs/%s' % app['sha1']
+        self.response.headers['Accept-Ranges'] = 'bytes'
+        if app['sha1'] in self.request.if_none_match:
+            self.response.status = 304
+            return
+        try:
+            byte_range = util.parse_byte_range(self.request.headers.get('Range'), size)
+        except ValueError as e:
+            self.abort(416, str(e), headers={'Content-Range': 'bytes */%d' % size})
+        start, stop = byte_range or (0, size)
+        if byte_range:
+            self.response.status = 206
+            self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        self.response.app_iter = util.iter_file_range(fp, start, stop)
+        self.response.headers['Content-Length'] = str(stop - start)  # must be set after setting app_iter
         self.response.headers['Content-Type'] = 'application/octet-stream'
         self.response.headers['Content-Disposition'] = 'attachment; filename=%s' % fn
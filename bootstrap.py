@@ -3,7 +3,10 @@
 # @author:  Gunnar Schaefer
 
 import os
+import bson
 import json
+import random
+import datetime
 import time
 import pymongo
 import hashlib
@@ -11,6 +14,7 @@ import logging
 import argparse
 
 import util
+import journal
 
 import scitran.data as scidata
 
@@ -60,6 +64,15 @@ example:
 """
 
 
+def create_job_indexes(db):
+    db.jobs.create_index([('status', 1), ('priority', -1), ('created', 1)])
+    db.jobs.create_index([('status', 1), ('group', 1), ('priority', -1), ('created', 1)])
+    db.jobs.create_index([('status', 1), ('project._id', 1), ('priority', -1), ('created', 1)])
+    db.jobs.create_index([('status', 1), ('lease_expires', 1)])
+    db.jobs.create_index([('status', 1), ('retry_at', 1)])
+    db.jobs.create_index('finished')
+
+
 def dbinit(args):
     db_client = connect_db(args.db_uri)
     db = db_client.get_default_database()
@@ -75,8 +88,28 @@ def dbinit(args):
     db.acquisitions.create_index('collections')
     db.authtokens.create_index('timestamp', expireAfterSeconds=600)
     db.uploads.create_index('timestamp', expireAfterSeconds=60)
-    db.downloads.create_index('timestamp', expireAfterSeconds=60)
-    # TODO: apps and jobs indexes (indicies?)
+    db.resumables.create_index('timestamp', expireAfterSeconds=3600)
+    db.ingests.create_index([('status', 1), ('timestamp', 1)])
+    db.ingests.create_index([('batch', 1), ('status', 1), ('timestamp', 1)])
+    db.ingests.create_index('finished', expireAfterSeconds=7*86400)
+    db.parse_cache.create_index('timestamp', expireAfterSeconds=30*86400)
+    if 'timestamp_1' in db.downloads.index_information(): # tickets used to expire 60s after creation
+        db.downloads.drop_index('timestamp_1')
+        db.downloads.delete_many({'expires': {'$exists': False}})
+    db.downloads.create_index('expires', expireAfterSeconds=0)
+    create_job_indexes(db)
+    if 'job_events' not in db.collection_names():
+        db.create_collection('job_events', capped=True, size=2**20)
+    elif not db.job_events.options().get('capped'): # auto-created by an insert before dbinit ran
+        db.command('convertToCapped', 'job_events', size=2**20)
+    if not db.job_events.find_one():
+        db.job_events.insert_one({'job': None, 'timestamp': datetime.datetime.utcnow()}) # tailable cursors die on empty collections
+    for job in db.jobs.find({'created': {'$exists': False}}, ['added']): # jobs queued before priorities
+        # 'added' is in the local time of the server, 'created' in UTC; run dbinit on the API host
+        created = job.get('added') and datetime.datetime.utcfromtimestamp(time.mktime(job['added'].timetuple()) + job['added'].microsecond / 1e6)
+        db.jobs.update_one({'_id': job['_id']}, {'$set': {'priority': 0, 'created': created}})
+    util.seed_job_counter(db)
+    # TODO: apps indexes (indicies?)
 
     if args.json:
         with open(args.json) as json_dump:
@@ -91,6 +124,7 @@ def dbinit(args):
             db.users.update({'_id': u['_id']}, {'$set': {'email_hash': hashlib.md5(u['email']).hexdigest()}})
 
     db.groups.update({'_id': 'unknown'}, {'$setOnInsert': {'name': 'Unknown', 'roles': []}}, upsert=True)
+    util.bump_generation(db, 'groups') # running API processes and ingest workers rebuild their group index
 
 dbinit_desc = """
 example:
@@ -122,6 +156,7 @@ def jobsinit(args):
 
     if args.force:
         db.drop_collection('jobs')
+        db.counters.delete_one({'_id': 'jobs'})
 
     # find all "orig" files, and create jobs for them
     for a in db.acquisitions.find({'files.filetype': 'dicom'}, ['uid', 'files.$']):
@@ -152,6 +187,7 @@ def sort(args):
     kwargs = dict(tz_aware=True)
     db_client = connect_db(args.db_uri, **kwargs)
     db = db_client.get_default_database()
+    util.recover_commits(db, args.sort_path)
     print 'inspecting %s' % args.path
     files = []
     for dirpath, dirnames, filenames in os.walk(args.path):
@@ -168,13 +204,14 @@ def sort(args):
             with open(filepath, 'rb') as fd:
                 for chunk in iter(lambda: fd.read(2**20), ''):
                     hash_.update(chunk)
-        datainfo = util.parse_file(filepath, hash_.hexdigest())
+        datainfo = util.parse_file(filepath, hash_.hexdigest(), None if args.quick else db.parse_cache)
         if datainfo is None:
             util.quarantine_file(filepath, quarantine_path)
             print 'Quarantining %s (unparsable)' % os.path.basename(filepath)
         else:
             util.commit_file(db.acquisitions, None, datainfo, filepath, args.sort_path)
             util.create_job(db.acquisitions, datainfo) # FIXME we should only mark files as new and let engine take it from there
+    journal.get_journal(os.path.join(args.sort_path, 'journal')).close()
 
 sort_desc = """
 example:
@@ -182,6 +219,145 @@ example:
 """
 
 
+def reconcile(args):
+    logging.basicConfig(level=logging.INFO)
+    db_client = connect_db(args.db_uri)
+    db = db_client.get_default_database()
+    util.recover_commits(db, args.data_path)
+    quarantine_path = os.path.join(args.data_path, 'quarantine') if args.fix else None
+    missing, orphaned = util.reconcile_files(db, args.data_path, quarantine_path)
+    for filepath in missing:
+        print 'missing     %s' % filepath
+    for filepath in orphaned:
+        print 'orphaned    %s' % filepath
+    print '%d missing files, %d orphaned files%s' % (len(missing), len(orphaned), ' (fixed)' if args.fix else '')
+
+reconcile_desc = """
+Compare the files of all containers with the sorted data. Stop the API and
+all sorting before running this, as files are moved into place before they
+are entered into the DB.
+
+example:
+./scripts/bootstrap.py reconcile --fix mongodb://localhost/nims /tmp/sorted
+"""
+
+
+class BenchHandler(object):
+
+    """Just enough of a request handler to call handler internals against a database."""
+
+    def __init__(self, db, **config):
+        self.app = argparse.Namespace(db=db, config=config)
+
+
+def scratch_db(db_uri):
+    db_client = connect_db(db_uri)
+    db = db_client.get_default_database()
+    if [c for c in db.collection_names() if not c.startswith('system.')]:
+        raise SystemExit('%s is not empty; benchmarks need a scratch database' % db.name)
+    return db_client, db
+
+
+def timings(seconds):
+    seconds = sorted(seconds)
+    return 'median %.2fms, p99 %.2fms, max %.2fms' % (seconds[len(seconds) / 2] * 1e3, seconds[int(len(seconds) * .99)] * 1e3, seconds[-1] * 1e3)
+
+
+def benchclaims(args):
+    import jobs
+    db_client, db = scratch_db(args.db_uri)
+    handler = BenchHandler(db, job_lease=300)
+    create_job_indexes(db)
+    groups = ['group%02d' % i for i in range(20)]
+    projects = [bson.ObjectId() for i in range(100)]
+    start = datetime.datetime.utcnow()
+    try:
+        seeded = 0
+        size = 1000
+        while size <= args.jobs:
+            batch = []
+            for i in range(seeded, size): # mostly finished jobs, as in a long-running instance
+                batch.append({
+                    '_id': i + 1,
+                    'status': 'pending' if random.random() < args.pending else 'done',
+                    'priority': random.choice([0, 0, 0, 1, 2]),
+                    'created': start + datetime.timedelta(seconds=i),
+                    'group': random.choice(groups),
+                    'project': {'_id': random.choice(projects)},
+                    })
+                if len(batch) == 10000:
+                    db.jobs.insert_many(batch)
+                    batch = []
+            if batch:
+                db.jobs.insert_many(batch)
+            seeded = size
+            for label, query in [('any', {}), ('group', {'group': groups[0]}), ('project', {'project._id': projects[0]})]:
+                seconds = []
+                for i in range(args.claims):
+                    t = time.time()
+                    claimed = jobs.Jobs._claim.im_func(handler, dict(query, status='pending'), 1)
+                    seconds.append(time.time() - t)
+                    for job in claimed: # requeue, so that small queues do not run dry
+                        db.jobs.update_one({'_id': job['_id']}, {'$set': {'status': 'pending'}})
+                print '%8d jobs, claim %-8s %s' % (size, label, timings(seconds))
+            size *= 10
+    finally:
+        db_client.drop_database(db)
+
+benchclaims_desc = """
+Seed a scratch database with 1k, 10k, ... jobs and time claims by Jobs.next,
+unfiltered and filtered by group and project. The database is dropped afterwards.
+
+example:
+./scripts/bootstrap.py benchclaims mongodb://localhost/bench_jobs
+"""
+
+
+def benchdownload(args):
+    import core
+    import tempfile
+    import shutil
+    db_client, db = scratch_db(args.db_uri)
+    data_path = tempfile.mkdtemp(prefix='benchdownload_')
+    handler = BenchHandler(db, data_path=data_path, download_path=data_path, download_lifetime=60)
+    try:
+        def add_container(collection, doc, files):
+            doc['_id'] = db[collection].insert_one(doc).inserted_id
+            container_path = os.path.join(data_path, str(doc['_id'])[-3:], str(doc['_id']))
+            os.makedirs(container_path)
+            for fn in files:
+                open(os.path.join(container_path, fn), 'w').close()
+            db[collection].update_one({'_id': doc['_id']}, {'$set': {'files': [{'filename': fn, 'filesize': 0} for fn in files]}})
+            return doc['_id']
+        files = ['file%02d.dcm' % i for i in range(args.files)]
+        project_id = add_container('projects', {'group': 'bench', 'name': 'bench'}, [])
+        for i in range(args.sessions):
+            session_id = add_container('sessions', {'project': project_id, 'label': 'session%04d' % i}, [])
+            for j in range(args.acquisitions):
+                add_container('acquisitions', {'session': session_id, 'label': 'acquisition%02d' % j}, files)
+        db.sessions.create_index('project')
+        db.acquisitions.create_index('session')
+        req_spec = {'optional': True, 'nodes': [{'level': 'project', '_id': str(project_id)}]}
+        seconds = []
+        for i in range(args.runs):
+            t = time.time()
+            result = core.Core._preflight_archivestream.im_func(handler, req_spec)
+            seconds.append(time.time() - t)
+        print '%d files in %d sessions, preflight %s' % (result['file_cnt'], args.sessions, timings(seconds))
+    finally:
+        db_client.drop_database(db)
+        shutil.rmtree(data_path)
+
+benchdownload_desc = """
+Seed a scratch database and a temporary data path with a synthetic project, by
+default 500 sessions of 20 acquisitions of 10 empty files, and time the
+preflight of its batch download. The database and files are removed afterwards.
+
+example:
+./scripts/bootstrap.py benchdownload mongodb://localhost/bench_download
+"""
+
+
 def upload(args):
     import util
     import datetime
@@ -290,11 +466,49 @@ sort_parser = subparsers.add_parser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
         )
 sort_parser.add_argument('-q', '--quick', action='store_true', help='omit computing of file checksums')
+sort_parser.add_argument('-n', '--node_id', help='node id to journal commits under, as --node_id of the API [hostname]')
 sort_parser.add_argument('db_uri', help='database URI')
 sort_parser.add_argument('path', help='filesystem path to data')
 sort_parser.add_argument('sort_path', help='filesystem path to sorted data')
 sort_parser.set_defaults(func=sort)
 
+reconcile_parser = subparsers.add_parser(
+        name='reconcile',
+        help='reconcile sorted data with the database',
+        description=reconcile_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+reconcile_parser.add_argument('-f', '--fix', action='store_true', help='remove entries of missing files and quarantine orphaned files')
+reconcile_parser.add_argument('-n', '--node_id', help='recover commits journaled under this node id, as --node_id of the API [hostname]')
+reconcile_parser.add_argument('db_uri', help='database URI')
+reconcile_parser.add_argument('data_path', help='filesystem path to sorted data')
+reconcile_parser.set_defaults(func=reconcile)
+
+benchclaims_parser = subparsers.add_parser(
+        name='benchclaims',
+        help='benchmark job claims',
+        description=benchclaims_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+benchclaims_parser.add_argument('-j', '--jobs', type=int, default=1000000, help='largest number of jobs [1000000]')
+benchclaims_parser.add_argument('-p', '--pending', type=float, default=0.1, help='fraction of pending jobs [0.1]')
+benchclaims_parser.add_argument('-c', '--claims', type=int, default=200, help='claims timed per size and filter [200]')
+benchclaims_parser.add_argument('db_uri', help='URI of an empty scratch database')
+benchclaims_parser.set_defaults(func=benchclaims)
+
+benchdownload_parser = subparsers.add_parser(
+        name='benchdownload',
+        help='benchmark batch download preflight',
+        description=benchdownload_desc,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        )
+benchdownload_parser.add_argument('-s', '--sessions', type=int, default=500, help='sessions [500]')
+benchdownload_parser.add_argument('-a', '--acquisitions', type=int, default=20, help='acquisitions per session [20]')
+benchdownload_parser.add_argument('-f', '--files', type=int, default=10, help='files per acquisition [10]')
+benchdownload_parser.add_argument('-r', '--runs', type=int, default=5, help='timed preflights [5]')
+benchdownload_parser.add_argument('db_uri', help='URI of an empty scratch database')
+benchdownload_parser.set_defaults(func=benchdownload)
+
 upload_parser = subparsers.add_parser(
         name='upload',
         help='upload all files in a directory tree',
@@ -307,4 +521,6 @@ upload_parser.add_argument('-n', '--no_verify', help='disable SSL verification',
 upload_parser.set_defaults(func=upload)
 
 args = parser.parse_args()
+if getattr(args, 'node_id', None):
+    util.node_id = args.node_id
 args.func(args)
@@ -8,6 +8,7 @@ import cgi
 import bson
 import json
 import shutil
+import struct
 import datetime
 import jsonschema
 
@@ -15,6 +16,8 @@ import tempdir as tempfile
 
 import base
 import util
+import tiles
+import ingests
 import users
 
 
@@ -112,6 +115,28 @@ FILE_ACCESS_SCHEMA = {
 }
 
 
+TILES_SCHEMA = {
+    '$schema': 'http://json-schema.org/draft-04/schema#',
+    'title': 'Tiles',
+    'type': 'object',
+    'properties': {
+        'tiles': {
+            'title': 'Tiles',
+            'type': 'array',
+            'maxItems': 256,
+            'items': {
+                'type': 'array',
+                'items': {'type': 'integer', 'minimum': 0, 'maximum': 2**32 - 1}, # packed as unsigned 32-bit ints
+                'minItems': 3,
+                'maxItems': 3,
+            },
+        },
+    },
+    'required': ['tiles'],
+    'additionalProperties': False,
+}
+
+
 class ContainerList(base.RequestHandler):
 
     def _post(self):
@@ -335,10 +360,60 @@ class Container(base.RequestHandler):
                     }
             throughput = filesize / duration.total_seconds()
             log.info('Received    %s [%s, %s/s] from %s' % (filename, util.hrsize(filesize), util.hrsize(throughput), self.request.client_addr))
-            util.commit_file(self.dbc, _id, datainfo, filepath, self.app.config['data_path'])
+            filepath = util.commit_file(self.dbc, _id, datainfo, filepath, self.app.config['data_path'])
+            if filetype == 'montage' and self.app.config['tile_prerender_levels'] and self.app.config['tile_cache_path']:
+                ingests.enqueue_prerender(self.app.db, filepath, digest)
 
     def get_tile(self, cid):
         """fetch info about a tiled tiff, or retrieve a specific tile."""
+        fp, filehash = self._montage(cid)
+        z = self.request.GET.get('z')
+        x = self.request.GET.get('x')
+        y = self.request.GET.get('y')
+        if not (z and x and y):
+            return tiles.get_info(fp)
+        else:
+            z, x, y = int(z), int(x), int(y)
+            etag = tiles.tile_key(filehash, z, x, y)
+            self.response.headers['ETag'] = '"%s"' % etag
+            self.response.headers['Cache-Control'] = 'private, max-age=86400'
+            if etag in self.request.if_none_match:
+                self.response.status = 304
+                return
+            tile = tiles.get_tile(fp, filehash, z, x, y, self.app.config['tile_cache_path'])
+            if tile:
+                self.response.content_type = 'image/jpeg'
+                self.response.write(tile)
+                if self.app.config['tile_prefetch_budget']:
+                    tiles.prefetch(fp, filehash, z, x, y, self.app.config['tile_prefetch_budget'], self.app.config['tile_cache_path'])
+            else:
+                self.abort(404, 'no such tile')
+
+    def get_tiles(self, cid):
+        """
+        Retrieve many tiles in one response.
+
+        The body lists the tiles as {"tiles": [[z, x, y], ...]}. The response concatenates,
+        for each tile in order, a header of four big-endian uint32 (z, x, y, length) and
+        the encoded tile. Tiles that do not exist have length 0.
+        """
+        try:
+            payload = self.request.json_body
+            jsonschema.validate(payload, TILES_SCHEMA)
+        except (ValueError, jsonschema.ValidationError) as e:
+            self.abort(400, str(e))
+        fp, filehash = self._montage(cid)
+        zxys = [tuple(t) for t in payload['tiles']]
+        encoded = tiles.get_tiles(fp, filehash, zxys, self.app.config['tile_cache_path'])
+        self.response.content_type = 'application/octet-stream'
+        self.response.headers['Cache-Control'] = 'private, max-age=86400'
+        for (z, x, y), tile in zip(zxys, encoded):
+            self.response.write(struct.pack('>IIII', z, x, y, len(tile or '')))
+            if tile:
+                self.response.write(tile)
+
+    def _montage(self, cid):
+        """Return path and content hash of the montage of a container, checking read access."""
         _id = bson.ObjectId(cid)
         container, _ = self._get(_id, 'ro')  # need at least read access to view tiles
         montage_info = None
@@ -350,13 +425,4 @@ class Container(base.RequestHandler):
             self.abort(404, 'montage zip not found')
         fn = montage_info['filename']
         fp = os.path.join(self.app.config['data_path'], cid[-3:], cid, fn)
-        z = self.request.GET.get('z')
-        x = self.request.GET.get('x')
-        y = self.request.GET.get('y')
-        if not (z and x and y):
-            return util.get_info(fp)
-        else:
-            self.response.content_type = 'image/jpeg'
-            tile = util.get_tile(fp, int(z), int(x), int(y))
-            if tile:
-                self.response.write(tile)
+        return fp, montage_info.get('filehash') or '%s-%d' % (fn, os.path.getmtime(fp))
@@ -7,19 +7,20 @@ logging.getLogger('MARKDOWN').setLevel(logging.WARNING) # silence Markdown libra
 import os
 import re
 import bson
-import gzip
+import shutil
 import json
+import time
 import hashlib
 import tarfile
+import uuid
 import datetime
-import lockfile
 import markdown
-import cStringIO
 import jsonschema
 
 import base
 import util
 import users
+import ingests
 import tempdir as tempfile
 
 UPLOAD_SCHEMA = {
@@ -54,6 +55,47 @@ UPLOAD_SCHEMA = {
     'additionalProperties': False,
 }
 
+RESUMABLE_SCHEMA = {
+    '$schema': 'http://json-schema.org/draft-04/schema#',
+    'title': 'Resumable Upload',
+    'type': 'object',
+    'properties': {
+        'filename': {
+            'type': 'string',
+            'pattern': '^[^/]+$',
+        },
+        'filesize': {
+            'type': 'integer',
+            'minimum': 1,
+        },
+        'sha1': {
+            'type': 'string',
+            'pattern': '^[0-9a-f]{40}$',
+        },
+        'container': {
+            'type': 'object',
+            'properties': {
+                'level': {
+                    'type': 'string',
+                    'enum': ['project', 'session', 'acquisition', 'collection'],
+                },
+                '_id': {
+                    'type': 'string',
+                    'pattern': '^[0-9a-f]{24}$',
+                },
+                'flavor': {
+                    'type': 'string',
+                    'enum': ['data', 'attachment'],
+                },
+            },
+            'required': ['level', '_id'],
+            'additionalProperties': False,
+        },
+    },
+    'required': ['filename', 'filesize'],
+    'additionalProperties': False,
+}
+
 DOWNLOAD_SCHEMA = {
     '$schema': 'http://json-schema.org/draft-04/schema#',
     'title': 'Download',
@@ -100,6 +142,31 @@ RESET_SCHEMA = {
 }
 
 
+def _tar_header(arcpath, size, mtime):
+    """Return the header of a download member, built from the manifest alone, so it is identical for every request."""
+    tarinfo = tarfile.TarInfo(arcpath)
+    tarinfo.size = size
+    tarinfo.mtime = mtime
+    return tarinfo.tobuf(tarfile.GNU_FORMAT, 'utf-8')
+
+
+def _member_data(filepath, start, stop):
+    """Yield the bytes [start, stop) of a download member, zero-filled if the file shrank or vanished after preflight."""
+    sent = 0
+    try:
+        for chunk in util.iter_file_range(filepath, start, stop):
+            sent += len(chunk)
+            yield chunk
+    except (IOError, OSError) as e:
+        log.warning('download member %s is unreadable: %s' % (filepath, e))
+    if start + sent < stop:
+        log.warning('download member %s is shorter than recorded, zero-filling' % filepath)
+        remaining = stop - start - sent
+        while remaining > 0:
+            yield '\0' * min(remaining, 2**20)
+            remaining -= 2**20
+
+
 class Core(base.RequestHandler):
 
     """/api """
@@ -122,8 +189,9 @@ class Core(base.RequestHandler):
             self.app.db.acquisitions.delete_many({})
             self.app.db.collections.delete_many({})
             self.app.db.jobs.delete_many({})
+            self.app.db.counters.delete_one({'_id': 'jobs'})
             for p in (self.app.config['data_path'] + '/' + d for d in os.listdir(self.app.config['data_path'])):
-                if p not in [self.app.config['upload_path'], self.app.config['quarantine_path']]:
+                if p not in [self.app.config['upload_path'], self.app.config['quarantine_path'], self.app.config['journal_path'], self.app.config['download_path']]:
                     shutil.rmtree(p)
 
     def get(self):
@@ -133,6 +201,10 @@ class Core(base.RequestHandler):
             :-----------------------------------|:-----------------------
             [(/sites)]                          | local and remote sites
             /upload                             | upload
+            /upload/resumable                   | start resumable upload
+            /upload/resumable/*<id>*            | offset, chunks and completion of resumable upload *<id>*
+            /ingests                            | batch upload; progress of batch with ?batch=*<id>*
+            /ingests/*<id>*                     | progress of ingest *<id>*
             /download                           | download
             [(/search)]                         | search
             [(/users)]                          | list of users
@@ -220,14 +292,16 @@ class Core(base.RequestHandler):
             if not tarfile.is_tarfile(filepath):
                 self.abort(415, 'Only tar files are accepted.')
             log.info('Received    %s [%s] from %s' % (filename, util.hrsize(self.request.content_length), self.request.user_agent))
-            datainfo = util.parse_file(filepath, digest)
-            if datainfo is None:
-                util.quarantine_file(filepath, self.app.config['quarantine_path'])
-                self.abort(202, 'Quarantining %s (unparsable)' % filename)
-            util.commit_file(self.app.db.acquisitions, None, datainfo, filepath, self.app.config['data_path'])
-            util.create_job(self.app.db.acquisitions, datainfo) # FIXME we should only mark files as new and let engine take it from there
+            ingest_id = self._enqueue(filepath, digest)
             throughput = filesize / duration.total_seconds()
             log.info('Received    %s [%s, %s/s] from %s' % (filename, util.hrsize(filesize), util.hrsize(throughput), self.request.client_addr))
+        return {'ingest': ingest_id}
+
+    def _enqueue(self, filepath, digest, create_job=True):
+        """Hand a received file to the ingest workers and respond with 202 Accepted."""
+        ingest_id = ingests.enqueue(self.app.db, self.app.config['ingest_path'], filepath, digest, self.uid, create_job)
+        self.response.set_status(202)
+        return ingest_id
 
     def upload(self):
         """
@@ -239,15 +313,15 @@ class Core(base.RequestHandler):
             3 - send a 'complete' message
         """
 
-        def store_file(fd, filename, md5, arcpath, arcname):
+        def store_file(fd, filename, md5, stagepath):
+            if os.path.basename(filename) != filename or filename.startswith('.'):
+                self.abort(400, 'invalid filename ' + filename)
             with tempfile.TemporaryDirectory(prefix='.tmp', dir=self.app.config['upload_path']) as tempdir_path:
                 filepath = os.path.join(tempdir_path, filename)
                 success, _, _, _ = util.receive_stream_and_validate(fd, filepath, md5)
                 if not success:
                     self.abort(400, 'Content-MD5 mismatch.')
-                with lockfile.LockFile(arcpath):
-                    with tarfile.open(arcpath, 'a') as archive:
-                        archive.add(filepath, os.path.join(arcname, filename))
+                os.rename(filepath, os.path.join(stagepath, filename)) # files of a ticket are staged independently, without locking
 
         if self.public_request:
             self.abort(403, 'must be logged in to upload data')
@@ -277,16 +351,20 @@ class Core(base.RequestHandler):
 
             acq_no = overwrites.get('acq_no')
             arcname = overwrites['series_uid'] + ('_' + str(acq_no) if acq_no is not None else '') + '_' + filetype
-            ticket = util.upload_ticket(arcname=arcname) # store arcname for later reference
+            ticket = util.upload_ticket(arcname=arcname, files=[]) # store arcname and manifest for later reference
+            stagepath = os.path.join(self.app.config['upload_path'], ticket['_id'])
+            os.mkdir(stagepath)
             self.app.db.uploads.insert_one(ticket)
-            arcpath = os.path.join(self.app.config['upload_path'], ticket['_id'] + '.tar')
-            store_file(self.request.body_file, filename, self.request.headers['Content-MD5'], arcpath, arcname)
+            store_file(self.request.body_file, filename, self.request.headers['Content-MD5'], stagepath)
+            self.app.db.uploads.update_one({'_id': ticket['_id']}, {'$addToSet': {'files': filename}}) # only files that were staged
             return {'ticket': ticket['_id']}
 
         ticket = self.app.db.uploads.find_one({'_id': ticket_id})
         if not ticket:
             self.abort(404, 'no such ticket')
-        arcpath = os.path.join(self.app.config['upload_path'], ticket_id + '.tar')
+        stagepath = os.path.join(self.app.config['upload_path'], ticket_id)
+        if not os.path.isdir(stagepath):
+            self.abort(410, 'upload has expired')
 
         if self.request.GET.get('complete', '').lower() not in ('1', 'true'):
             if 'Content-MD5' not in self.request.headers:
@@ -295,100 +373,326 @@ class Core(base.RequestHandler):
             if not filename:
                 self.app.db.uploads.remove({'_id': ticket_id}) # delete ticket
                 self.abort(400, 'Request must contain a filename query parameter.')
-            self.app.db.uploads.update_one({'_id': ticket_id}, {'$set': {'timestamp': datetime.datetime.utcnow()}}) # refresh ticket
-            store_file(self.request.body_file, filename, self.request.headers['Content-MD5'], arcpath, ticket['arcname'])
-        else: # complete -> zip, hash, commit
-            filepath = arcpath[:-2] + 'gz'
-            with gzip.open(filepath, 'wb', compresslevel=6) as gzfile:
-                with open(arcpath) as rawfile:
-                    gzfile.writelines(rawfile)
-            os.remove(arcpath)
-            sha1 = hashlib.sha1()
-            with open(filepath, 'rb') as fd:
-                for chunk in iter(lambda: fd.read(2**20), ''):
-                    sha1.update(chunk)
-            datainfo = util.parse_file(filepath, sha1.hexdigest())
-            if datainfo is None:
-                util.quarantine_file(filepath, self.app.config['quarantine_path'])
-                self.abort(202, 'Quarantining %s (unparsable)' % filename)
-            util.commit_file(self.app.db.acquisitions, None, datainfo, filepath, self.app.config['data_path'])
+            store_file(self.request.body_file, filename, self.request.headers['Content-MD5'], stagepath)
+            self.app.db.uploads.update_one( # refresh ticket and record file in manifest
+                    {'_id': ticket_id},
+                    {'$set': {'timestamp': datetime.datetime.utcnow()}, '$addToSet': {'files': filename}},
+                    )
+        else: # complete -> tar, zip, hash, commit
+            ticket = self.app.db.uploads.find_one_and_delete({'_id': ticket_id}) # latest manifest; prevents a second completion
+            if not ticket:
+                self.abort(404, 'no such ticket')
+            codec = self.app.config.get('upload_codec', 'gzip')
+            filepath = stagepath + util.ARCHIVE_EXTENSIONS[codec]
+            with util.compressed_writer(filepath, codec, self.app.config.get('upload_compresslevel', 6), self.app.config.get('compress_threads')) as fd:
+                with tarfile.open(mode='w|', fileobj=fd) as archive: # build tar only once, in manifest order
+                    for fn in ticket['files']:
+                        archive.add(os.path.join(stagepath, fn), os.path.join(ticket['arcname'], fn))
+            shutil.rmtree(stagepath)
+            return {'ingest': self._enqueue(filepath, fd.hexdigest(), create_job=False)}
+
+    def resumable_start(self):
+        """
+        Open a resumable upload session.
+
+        The session preallocates the target file, after which chunks can be PUT
+        at arbitrary offsets, in any order and in parallel. Without a target
+        container, the finished file is sorted like a reaper upload.
+        """
+        if self.public_request:
+            self.abort(403, 'must be logged in to upload data')
+        try:
+            json_body = self.request.json_body
+            jsonschema.validate(json_body, RESUMABLE_SCHEMA)
+        except (ValueError, jsonschema.ValidationError) as e:
+            self.abort(400, str(e))
+        container = json_body.get('container')
+        if container:
+            self._resumable_container(container)
+        ticket = util.upload_ticket(
+                uid=self.uid,
+                filename=json_body['filename'],
+                filesize=json_body['filesize'],
+                sha1=json_body.get('sha1'),
+                container=container,
+                chunks=[],
+                state='open',
+                writers=[],     # chunks being copied into the part file, see _resumable_put_chunk
+                )
+        with open(os.path.join(self.app.config['upload_path'], ticket['_id'] + '.part'), 'wb') as fd:
+            fd.truncate(ticket['filesize'])
+        self.app.db.resumables.insert_one(ticket)
+        return {'upload': ticket['_id'], 'offset': 0}
+
+    def resumable(self, upload_id):
+        """
+        Query, extend or finalize a resumable upload session.
+
+        GET returns the committed offset, PUT ?offset=<n> stores one chunk, and
+        POST verifies that the file is complete and commits it.
+        """
+        ticket = self.app.db.resumables.find_one({'_id': upload_id})
+        if not ticket:
+            self.abort(404, 'no such upload')
+        if ticket['uid'] != self.uid and not self.superuser_request:
+            self.abort(403, 'upload belongs to a different user')
+        partpath = os.path.join(self.app.config['upload_path'], upload_id + '.part')
+        if not os.path.exists(partpath):
+            self.app.db.resumables.delete_one({'_id': upload_id})
+            self.abort(410, 'upload has expired')
+        if self.request.method == 'PUT':
+            self._resumable_put_chunk(ticket, partpath)
+            ticket = self.app.db.resumables.find_one({'_id': upload_id})
+        elif self.request.method == 'POST':
+            return self._resumable_finalize(ticket, partpath)
+        ranges = util.merge_ranges(ticket['chunks'])
+        return {
+                'upload': upload_id,
+                'filesize': ticket['filesize'],
+                'offset': ranges[0][1] if ranges and ranges[0][0] == 0 else 0,
+                'ranges': ranges,
+                }
+
+    def _resumable_container(self, container):
+        dbc = getattr(self.app.db, container['level'] + 's')
+        doc = dbc.find_one({'_id': bson.ObjectId(container['_id'])}, ['permissions'])
+        if not doc:
+            self.abort(404, 'no such ' + container['level'])
+        if not self.superuser_request:
+            user_perm = util.user_perm(doc['permissions'], self.uid, self.source_site)
+            if not user_perm:
+                self.abort(403, self.uid + ' does not have permissions on this ' + container['level'])
+            if users.INTEGER_ROLES[user_perm['access']] < users.INTEGER_ROLES['rw']:
+                self.abort(403, self.uid + ' does not have at least rw permissions on this ' + container['level'])
+        return dbc
+
+    def _resumable_put_chunk(self, ticket, partpath):
+        if ticket['state'] != 'open':
+            self.abort(409, 'upload is being finalized')
+        if 'Content-MD5' not in self.request.headers:
+            self.abort(400, 'Request must contain a valid "Content-MD5" header.')
+        try:
+            offset = int(self.request.GET.get('offset', ''))
+        except ValueError:
+            self.abort(400, 'Request must contain an integer offset query parameter.')
+        length = self.request.content_length
+        if length is None:
+            self.abort(411, 'Request must contain a "Content-Length" header.')
+        if offset < 0 or offset + length > ticket['filesize']:
+            self.abort(416, 'chunk [%d, %d) outside of file [0, %d)' % (offset, offset + length, ticket['filesize']))
+        with tempfile.TemporaryDirectory(prefix='.tmp', dir=self.app.config['upload_path']) as tempdir_path:
+            chunkpath = os.path.join(tempdir_path, 'chunk')
+            success, _, received, _ = util.receive_stream_and_validate(self.request.body_file, chunkpath, self.request.headers['Content-MD5'])
+            if not success or received != length:
+                self.abort(400, 'Content-MD5 mismatch.')
+            # only verified chunks touch the part file, and never while it is being finalized;
+            # the writer marker expires, so that a writer that died does not block finalizing forever
+            writer = {
+                    'token': str(uuid.uuid4()),
+                    'expires': datetime.datetime.utcnow() + datetime.timedelta(seconds=60 + length / 2**20), # at least 1MB/s
+                    }
+            if not self.app.db.resumables.find_one_and_update({'_id': ticket['_id'], 'state': 'open'}, {'$push': {'writers': writer}}):
+                self.abort(409, 'upload is being finalized')
+            try:
+                util.write_at_offset(chunkpath, partpath, offset)
+            except:
+                self.app.db.resumables.update_one({'_id': ticket['_id']}, {'$pull': {'writers': {'token': writer['token']}}})
+                raise
+        self.app.db.resumables.update_one(
+                {'_id': ticket['_id']},
+                {'$pull': {'writers': {'token': writer['token']}}, '$push': {'chunks': [offset, offset + length]}, '$set': {'timestamp': datetime.datetime.utcnow()}},
+                )
+
+    def _resumable_finalize(self, ticket, partpath):
+        ticket = self.app.db.resumables.find_one_and_update(
+                {'_id': ticket['_id'], 'state': 'open', 'writers': {'$not': {'$elemMatch': {'expires': {'$gt': datetime.datetime.utcnow()}}}}},
+                {'$set': {'state': 'finalizing'}},
+                )
+        if not ticket:
+            self.abort(409, 'upload is already being finalized, or chunks are still being written')
+        if util.merge_ranges(ticket['chunks']) != [[0, ticket['filesize']]]:
+            self.app.db.resumables.update_one({'_id': ticket['_id']}, {'$set': {'state': 'open'}})
+            self.abort(400, 'upload is incomplete')
+        sha1 = hashlib.sha1()
+        with open(partpath, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(2**20), ''):
+                sha1.update(chunk)
+        self.app.db.resumables.delete_one({'_id': ticket['_id']})
+        if ticket['sha1'] and sha1.hexdigest() != ticket['sha1']:
+            os.remove(partpath)
+            self.abort(400, 'SHA-1 mismatch.')
+        with tempfile.TemporaryDirectory(prefix='.tmp', dir=self.app.config['upload_path']) as tempdir_path:
+            filepath = os.path.join(tempdir_path, ticket['filename'])
+            os.rename(partpath, filepath)
+            log.info('Received    %s [%s] from %s (resumable)' % (ticket['filename'], util.hrsize(ticket['filesize']), self.request.client_addr))
+            container = ticket['container']
+            if not container:
+                if not tarfile.is_tarfile(filepath):
+                    self.abort(415, 'Only tar files are accepted.')
+                return {'upload': ticket['_id'], 'sha1': sha1.hexdigest(), 'ingest': self._enqueue(filepath, sha1.hexdigest())}
+            else:
+                dbc = self._resumable_container(container)
+                mimetype = util.guess_mimetype(filepath)
+                datainfo = {
+                        'fileinfo': {
+                            'filename': ticket['filename'],
+                            'filesize': ticket['filesize'],
+                            'filehash': sha1.hexdigest(),
+                            'filetype': util.guess_filetype(filepath, mimetype),
+                            'flavor': container.get('flavor', 'data'),
+                            'mimetype': mimetype,
+                            'tags': [],
+                            'metadata': {},
+                            },
+                        }
+                util.commit_file(dbc, bson.ObjectId(container['_id']), datainfo, filepath, self.app.config['data_path'])
+        return {'upload': ticket['_id'], 'sha1': sha1.hexdigest()}
 
     def _preflight_archivestream(self, req_spec):
         data_path = self.app.config['data_path']
         arc_prefix = 'sdm'
 
-        def append_targets(targets, container, prefix, total_size, total_cnt):
+        mtime = int(time.time())
+        totals = {'size': 0, 'cnt': 0, 'offset': 0}
+
+        def append_targets(manifest, container, prefix):
             prefix = arc_prefix + '/' + prefix
-            for f in container['files']:
+            container_path = os.path.join(data_path, str(container['_id'])[-3:] + '/' + str(container['_id']))
+            try:
+                existing = set(os.listdir(container_path)) if container.get('files') else set()
+            except OSError:
+                existing = set()
+            for f in container.get('files', []):
                 if req_spec['optional'] or not f.get('optional', False):
-                    filepath = os.path.join(data_path, str(container['_id'])[-3:] + '/' + str(container['_id']), f['filename'])
-                    if os.path.exists(filepath): # silently skip missing files
-                        targets.append((filepath, prefix + '/' + f['filename'], f['filesize']))
-                        total_size += f['filesize']
-                        total_cnt += 1
-            return total_size, total_cnt
-
-        file_cnt = 0
-        total_size = 0
-        targets = []
+                    if f['filename'] in existing: # silently skip missing files
+                        arcpath = prefix + '/' + f['filename']
+                        manifest.write(json.dumps([os.path.join(container_path, f['filename']), arcpath, f['filesize'], totals['offset']]) + '\n')
+                        totals['offset'] += len(_tar_header(arcpath, f['filesize'], mtime)) + f['filesize'] + (-f['filesize'] % tarfile.BLOCKSIZE)
+                        totals['size'] += f['filesize']
+                        totals['cnt'] += 1
+
+        def find_in(collection, field, ids, projection):
+            return list(self.app.db[collection].find({field: {'$in': ids}}, projection)) if ids else []
+
+        # resolve all nodes with one query per collection and direction, instead of per container
+        item_ids = dict((level, [bson.ObjectId(item['_id']) for item in req_spec['nodes'] if item['level'] == level]) for level in ['project', 'session', 'acquisition'])
+        acquisitions = dict((acq['_id'], acq) for acq in find_in('acquisitions', '_id', item_ids['acquisition'], ['session', 'label', 'files']))
+        session_ids = item_ids['session'] + [acq['session'] for acq in acquisitions.itervalues()]
+        sessions = dict((session['_id'], session) for session in find_in('sessions', '_id', session_ids, ['project', 'label', 'files']))
+        project_ids = item_ids['project'] + [session['project'] for session in sessions.itervalues()]
+        projects = dict((project['_id'], project) for project in find_in('projects', '_id', project_ids, ['group', 'name', 'files']))
+        project_sessions = {}
+        for session in find_in('sessions', 'project', item_ids['project'], ['project', 'label', 'files']):
+            project_sessions.setdefault(session['project'], []).append(session)
+        session_acquisitions = {}
+        for acq in find_in('acquisitions', 'session', item_ids['session'] + [session['_id'] for ss in project_sessions.itervalues() for session in ss], ['session', 'label', 'files']):
+            session_acquisitions.setdefault(acq['session'], []).append(acq)
+
+        # the manifest is spilled to disk as NDJSON, as selections can exceed the BSON document limit
+        manifest_path = os.path.join(self.app.config['download_path'], str(uuid.uuid4()) + '.ndjson')
+        manifest = open(manifest_path + '.tmp', 'w')
         # FIXME: check permissions of everything
         for item in req_spec['nodes']:
             item_id = bson.ObjectId(item['_id'])
             if item['level'] == 'project':
-                project = self.app.db.projects.find_one({'_id': item_id}, ['group', 'name', 'files'])
+                project = projects[item_id]
                 prefix = project['group'] + '/' + project['name']
-                total_size, file_cnt = append_targets(targets, project, prefix, total_size, file_cnt)
-                sessions = self.app.db.sessions.find({'project': item_id}, ['label', 'files'])
-                for session in sessions:
+                append_targets(manifest, project, prefix)
+                for session in project_sessions.get(item_id, []):
                     session_prefix = prefix + '/' + session.get('label', 'untitled')
-                    total_size, file_cnt = append_targets(targets, session, session_prefix, total_size, file_cnt)
-                    acquisitions = self.app.db.acquisitions.find({'session': session['_id']}, ['label', 'files'])
-                    for acq in acquisitions:
+                    append_targets(manifest, session, session_prefix)
+                    for acq in session_acquisitions.get(session['_id'], []):
                         acq_prefix = session_prefix + '/' + acq.get('label', 'untitled')
-                        total_size, file_cnt = append_targets(targets, acq, acq_prefix, total_size, file_cnt)
+                        append_targets(manifest, acq, acq_prefix)
             elif item['level'] == 'session':
-                session = self.app.db.sessions.find_one({'_id': item_id}, ['project', 'label', 'files'])
-                project = self.app.db.projects.find_one({'_id': session['project']}, ['group', 'name'])
+                session = sessions[item_id]
+                project = projects[session['project']]
                 prefix = project['group'] + '/' + project['name'] + '/' + session.get('label', 'untitled')
-                total_size, file_cnt = append_targets(targets, session, prefix, total_size, file_cnt)
-                acquisitions = self.app.db.acquisitions.find({'session': item_id}, ['label', 'files'])
-                for acq in acquisitions:
+                append_targets(manifest, session, prefix)
+                for acq in session_acquisitions.get(item_id, []):
                     acq_prefix = prefix + '/' + acq.get('label', 'untitled')
-                    total_size, file_cnt = append_targets(targets, acq, acq_prefix, total_size, file_cnt)
+                    append_targets(manifest, acq, acq_prefix)
             elif item['level'] == 'acquisition':
-                acq = self.app.db.acquisitions.find_one({'_id': item_id}, ['session', 'label', 'files'])
-                session = self.app.db.sessions.find_one({'_id': acq['session']}, ['project', 'label'])
-                project = self.app.db.projects.find_one({'_id': session['project']}, ['group', 'name'])
+                acq = acquisitions[item_id]
+                session = sessions[acq['session']]
+                project = projects[session['project']]
                 prefix = project['group'] + '/' + project['name'] + '/' + session.get('label', 'untitled') + '/' + acq.get('label', 'untitled')
-                total_size, file_cnt = append_targets(targets, acq, prefix, total_size, file_cnt)
-        log.debug(json.dumps(targets, sort_keys=True, indent=4, separators=(',', ': ')))
+                append_targets(manifest, acq, prefix)
+        manifest.close()
+        os.rename(manifest_path + '.tmp', manifest_path)
+        # end-of-archive marker, padded to a full record, as written by tarfile
+        archive_size = totals['offset'] + 2 * tarfile.BLOCKSIZE
+        archive_size += -archive_size % tarfile.RECORDSIZE
+        log.debug('download manifest %s: %d files, %s' % (manifest_path, totals['cnt'], util.hrsize(totals['size'])))
         filename = 'sdm_' + datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S') + '.tar'
-        ticket = util.download_ticket('batch', targets, filename, total_size)
+        ticket = util.download_ticket('batch', manifest_path, filename, archive_size, self.app.config['download_lifetime'])
+        ticket['mtime'] = mtime
+        ticket['trailer'] = totals['offset']
         self.app.db.downloads.insert(ticket)
-        return {'ticket': ticket['_id'], 'file_cnt': file_cnt, 'size': total_size}
-
-    def _archivestream(self, ticket):
-        BLOCKSIZE = 512
-        CHUNKSIZE = 2**20  # stream files in 1MB chunks
-        stream = cStringIO.StringIO()
-        with tarfile.open(mode='w|', fileobj=stream) as archive:
-            for filepath, arcpath, _ in ticket['target']:
-                yield archive.gettarinfo(filepath, arcpath).tobuf()
-                with open(filepath, 'rb') as fd:
-                    for chunk in iter(lambda: fd.read(CHUNKSIZE), ''):
+        return {'ticket': ticket['_id'], 'file_cnt': totals['cnt'], 'size': totals['size'], 'archive_size': archive_size}
+
+    def _archivestream(self, ticket, start, stop):
+        """
+        Yield the bytes [start, stop) of the tar archive of a ticket.
+
+        Members are laid out at the offsets recorded in the manifest, with headers rebuilt from
+        the manifest alone, so every request of a ticket sees the same archive and resumed
+        downloads line up. Members before start are skipped without touching their files.
+        """
+        def clip(offset, length):
+            return max(start, offset), min(stop, offset + length)
+
+        with open(ticket['target']) as manifest:
+            for filepath, arcpath, size, offset in (json.loads(line) for line in manifest):
+                header = _tar_header(arcpath, size, ticket['mtime'])
+                data_offset = offset + len(header)
+                padding = -size % tarfile.BLOCKSIZE
+                if data_offset + size + padding <= start:
+                    continue
+                if offset >= stop:
+                    return
+                lo, hi = clip(offset, len(header))
+                if lo < hi:
+                    yield header[lo - offset:hi - offset]
+                lo, hi = clip(data_offset, size)
+                if lo < hi:
+                    for chunk in _member_data(filepath, lo - data_offset, hi - data_offset):
                         yield chunk
-                    if len(chunk) % BLOCKSIZE != 0:
-                        yield (BLOCKSIZE - (len(chunk) % BLOCKSIZE)) * b'\0'
-        yield stream.getvalue() # get tar stream trailer
-        stream.close()
+                lo, hi = clip(data_offset + size, padding)
+                if lo < hi:
+                    yield '\0' * (hi - lo)
+        lo, hi = clip(ticket['trailer'], ticket['size'] - ticket['trailer'])
+        if lo < hi:
+            yield '\0' * (hi - lo)
 
     def download(self):
         ticket_id = self.request.GET.get('ticket')
         if ticket_id:
-            ticket = self.app.db.downloads.find_one({'_id': ticket_id})
+            # every use extends the ticket, so interrupted downloads can be resumed later
+            expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.app.config['download_lifetime'])
+            ticket = self.app.db.downloads.find_one_and_update({'_id': ticket_id, 'type': 'batch'}, {'$set': {'expires': expires}})
             if not ticket:
                 self.abort(404, 'no such ticket')
-            self.response.app_iter = self._archivestream(ticket)
+            try:
+                os.utime(ticket['target'], None) # keeps the manifest from being cleaned up while in use
+            except OSError:
+                self.abort(410, 'download manifest no longer exists')
+            size = ticket['size']
+            etag = '"%s"' % ticket['_id']
+            self.response.headers['ETag'] = etag
+            self.response.headers['Accept-Ranges'] = 'bytes'
+            byte_range = None
+            if self.request.headers.get('If-Range', etag) == etag:
+                try:
+                    byte_range = util.parse_byte_range(self.request.headers.get('Range'), size)
+                except ValueError as e:
+                    self.abort(416, str(e), headers={'Content-Range': 'bytes */%d' % size})
+            start, stop = byte_range or (0, size)
+            if byte_range:
+                self.response.status = 206
+                self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1, size)
+            self.response.app_iter = self._archivestream(ticket, start, stop)
+            self.response.headers['Content-Length'] = str(stop - start)  # must be set after setting app_iter
             self.response.headers['Content-Type'] = 'application/octet-stream'
             self.response.headers['Content-Disposition'] = 'attachment; filename=' + str(ticket['filename'])
         else:
@@ -0,0 +1,256 @@
+"""
+Asynchronous ingest of sortable uploads.
+
+Upload handlers only persist and validate the received bytes and enqueue them
+here. A pool of worker processes then parses, sorts and commits each file and
+creates its default job, recording progress and errors on the ingest document.
+"""
+
+import logging
+log = logging.getLogger('scitran.api')
+
+import os
+import json
+import time
+import uuid
+import shutil
+import tarfile
+import pymongo
+import datetime
+
+import base
+import util
+import tiles
+import tempdir as tempfile
+
+INGEST_STATES = [
+    'pending',      # persisted, waiting for a worker
+    'running',      # claimed by a worker
+    'done',         # sorted and committed
+    'quarantined',  # unparsable
+    'failed',       # some error occurred
+]
+
+
+def enqueue(db, ingest_path, filepath, digest, uid=None, create_job=True, batch=None):
+    """Move a received file into durable ingest storage and queue it; return the ingest id."""
+    _id = str(uuid.uuid4())
+    filename = os.path.basename(filepath)
+    ingest_dir = os.path.join(ingest_path, _id)
+    os.mkdir(ingest_dir)
+    os.rename(filepath, os.path.join(ingest_dir, filename))
+    now = datetime.datetime.utcnow()
+    db.ingests.insert_one({
+        '_id': _id,
+        'uid': uid,
+        'filename': filename,
+        'filesize': os.path.getsize(os.path.join(ingest_dir, filename)),
+        'filehash': digest,
+        'create_job': create_job,
+        'batch': batch,
+        'status': 'pending',
+        'stage': 'queued',
+        'timestamp': now,
+        'modified': now,
+    })
+    return _id
+
+
+def enqueue_prerender(db, filepath, filehash):
+    """Queue prerendering of the lowest zoom levels of a committed montage; return the ingest id."""
+    _id = str(uuid.uuid4())
+    now = datetime.datetime.utcnow()
+    db.ingests.insert_one({
+        '_id': _id,
+        'type': 'prerender',
+        'uid': None,
+        'path': filepath,
+        'filename': os.path.basename(filepath),
+        'filehash': filehash,
+        'batch': None,
+        'status': 'pending',
+        'stage': 'queued',
+        'timestamp': now,
+        'modified': now,
+    })
+    return _id
+
+
+def _claim(db, batch=None):
+    query = {'status': 'pending'}
+    if batch:
+        query['batch'] = batch
+    return db.ingests.find_one_and_update(
+            query,
+            {'$set': {'status': 'running', 'stage': 'claimed', 'host': util.node_id, 'pid': os.getpid(), 'claimed': time.time(), 'modified': datetime.datetime.utcnow()}},
+            sort=[('timestamp', 1)],
+            return_document=pymongo.ReturnDocument.AFTER,
+            )
+
+
+def _update(db, ingest, **kwargs):
+    kwargs['modified'] = datetime.datetime.utcnow()
+    if kwargs.get('status') in ('done', 'quarantined', 'failed'):
+        kwargs['finished'] = kwargs['modified']
+    db.ingests.update_one({'_id': ingest['_id']}, {'$set': kwargs})
+
+
+def process(db, config, ingest):
+    """Parse, sort and commit one claimed ingest, and create its default job."""
+    if ingest.get('type') == 'prerender':
+        return _prerender(db, config, ingest, ingest['path'])
+    ingest_dir = os.path.join(config['ingest_path'], ingest['_id'])
+    filepath = os.path.join(ingest_dir, ingest['filename'])
+    try:
+        _update(db, ingest, stage='parsing')
+        datainfo = util.parse_file(filepath, ingest['filehash'], db.parse_cache)
+        if datainfo is None:
+            util.quarantine_file(filepath, config['quarantine_path'])
+            _update(db, ingest, status='quarantined', stage='unparsable')
+            log.info('Quarantined %s (unparsable)' % ingest['filename'])
+        else:
+            _update(db, ingest, stage='sorting')
+            committed_path = util.commit_file(db.acquisitions, None, datainfo, filepath, config['data_path'])
+            if datainfo['fileinfo'].get('filetype') == 'montage' and config['tile_prerender_levels'] and config['tile_cache_path']:
+                _prerender(db, config, ingest, committed_path, final=False)
+            if ingest['create_job']:
+                _update(db, ingest, stage='creating job')
+                util.create_job(db.acquisitions, datainfo) # FIXME we should only mark files as new and let engine take it from there
+            _update(db, ingest, status='done', stage='committed', acquisition_uid=datainfo['acquisition_id'])
+    except Exception as e:
+        log.exception('Ingest of %s failed' % ingest['filename'])
+        if os.path.exists(filepath):
+            util.quarantine_file(filepath, config['quarantine_path'])
+        _update(db, ingest, status='failed', error='%s: %s' % (e.__class__.__name__, e))
+    shutil.rmtree(ingest_dir, ignore_errors=True)
+
+
+def _prerender(db, config, ingest, filepath, final=True):
+    """Prerender a montage into the tile cache; failures only cost first-view latency, so they are logged."""
+    _update(db, ingest, stage='prerendering')
+    try:
+        count = tiles.prerender(filepath, ingest['filehash'], config['tile_prerender_levels'], config['tile_cache_path'])
+        log.info('Prerendered %d tiles of %s' % (count, os.path.basename(filepath)))
+    except Exception:
+        log.exception('Prerendering of %s failed' % os.path.basename(filepath))
+    if final:
+        _update(db, ingest, status='done', stage='prerendered')
+
+
+def requeue_orphans(db):
+    """Return ingests claimed by dead worker processes of this node to the queue."""
+    for ingest in db.ingests.find({'status': 'running', 'host': util.node_id}, ['pid', 'claimed']):
+        if not util.pid_alive(ingest['pid'], ingest.get('claimed')): # the pid may have been reused since the claim
+            r = db.ingests.update_one({'_id': ingest['_id'], 'status': 'running', 'pid': ingest['pid']}, {'$set': {'status': 'pending', 'stage': 'requeued'}})
+            if r.modified_count:
+                log.warning('requeued orphaned ingest %s' % ingest['_id'])
+
+
+def run(db_uri, config, poll_interval=1.):
+    """Worker loop; connects on its own, since workers run in forked processes."""
+    db = pymongo.MongoClient(db_uri).get_default_database()
+    requeue_orphans(db)
+    util.recover_commits(db, config['data_path'])
+    log.info('ingest worker %d started' % os.getpid())
+    while True:
+        ingest = _claim(db)
+        if not ingest:
+            time.sleep(poll_interval)
+        while ingest: # drain the rest of a batch in this worker, to make use of the hierarchy cache
+            process(db, config, ingest)
+            ingest = ingest.get('batch') and _claim(db, ingest['batch'])
+
+
+class Ingests(base.RequestHandler):
+
+    """/ingests """
+
+    def post(self):
+        """
+        Receive a batch of sortable files in one request.
+
+        The body is an uncompressed tar stream. Its first member must be MANIFEST.json,
+        mapping each following member name to its MD5. Each member is validated and
+        queued as it streams in; the response lists the outcome for every file. If the
+        stream breaks off, the files queued so far are still reported, and the rest are
+        rejected with the error.
+        """
+        batch = str(uuid.uuid4())
+        results = []
+        checksums = None
+        error = None
+        with tempfile.TemporaryDirectory(prefix='.tmp', dir=self.app.config['upload_path']) as tempdir_path:
+            try:
+                with tarfile.open(fileobj=self.request.body_file, mode='r|') as stream:
+                    for tarinfo in stream:
+                        if not tarinfo.isfile():
+                            continue
+                        if checksums is None:
+                            if tarinfo.name != 'MANIFEST.json':
+                                self.abort(400, 'first member must be MANIFEST.json')
+                            try:
+                                checksums = json.load(stream.extractfile(tarinfo))
+                            except ValueError as e:
+                                self.abort(400, 'invalid MANIFEST.json: ' + str(e))
+                            if not isinstance(checksums, dict):
+                                self.abort(400, 'MANIFEST.json must map member names to MD5 checksums')
+                            continue
+                        results.append(self._receive(stream, tarinfo, checksums.get(tarinfo.name), tempdir_path, batch))
+                        checksums.pop(tarinfo.name, None) # only once received, so that a member cut off is reported below
+            except (tarfile.TarError, IOError) as e:
+                if checksums is None:
+                    self.abort(400, 'invalid tar stream: ' + str(e))
+                error = 'stream broke off: %s' % e
+                log.warning('Batch %s from %s broke off: %s' % (batch, self.request.client_addr, e))
+        if checksums is None:
+            self.abort(400, 'empty batch')
+        for name in sorted(checksums):
+            results.append({'filename': name, 'status': 'rejected', 'error': error or 'missing from stream'})
+        log.info('Received    batch %s [%d/%d files accepted] from %s' % (batch, sum(r['status'] == 'accepted' for r in results), len(results), self.request.client_addr))
+        self.response.set_status(202)
+        response = {'batch': batch, 'files': results}
+        if error:
+            response['error'] = error
+        return response
+
+    def _receive(self, stream, tarinfo, md5, tempdir_path, batch):
+        result = {'filename': tarinfo.name, 'status': 'rejected'}
+        if md5 is None:
+            result['error'] = 'no checksum in MANIFEST.json'
+            return result
+        filepath = os.path.join(tempdir_path, os.path.basename(tarinfo.name))
+        success, digest, _, _ = util.receive_stream_and_validate(stream.extractfile(tarinfo), filepath, md5)
+        if not success:
+            result['error'] = 'Content-MD5 mismatch'
+        elif not tarfile.is_tarfile(filepath):
+            result['error'] = 'not a tar file'
+        else:
+            result['status'] = 'accepted'
+            result['ingest'] = enqueue(self.app.db, self.app.config['ingest_path'], filepath, digest, self.uid, batch=batch)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        return result
+
+    def get(self):
+        """Return the progress of all ingests of one batch."""
+        batch = self.request.GET.get('batch')
+        if not batch:
+            self.abort(400, 'Request must contain a batch query parameter.')
+        query = {'batch': batch}
+        if not self.superuser_request:
+            query['uid'] = self.uid
+        return list(self.app.db.ingests.find(query, {'host': 0, 'pid': 0, 'claimed': 0}).sort('timestamp', 1))
+
+
+class Ingest(base.RequestHandler):
+
+    """/ingests/<_id> """
+
+    def get(self, _id):
+        """Return the progress of one ingest."""
+        ingest = self.app.db.ingests.find_one({'_id': _id}, {'host': 0, 'pid': 0, 'claimed': 0})
+        if not ingest:
+            self.abort(404, 'no such ingest')
+        if not self.superuser_request and ingest['uid'] != self.uid:
+            self.abort(403, 'ingest belongs to a different user')
+        return ingest
@@ -4,11 +4,18 @@
 API request handlers for process-job-handling.
 """
 
+import bson
+import math
+import time
+import uuid
 import logging
+import pymongo
+import pymongo.errors
 import datetime
 log = logging.getLogger('scitran.jobs')
 
 import base
+import util
 
 # TODO: what should this whitelist contain? protocol + FQDN?
 # ex. https://coronal.stanford.edu
@@ -20,11 +27,29 @@ JOB_STATES = [
     'pending',      # created but not started
     'queued',       # job claimed by a processor
     'running',      # job running on a processor
+    'retrying',     # lease of processor expired, waiting to be requeued
     'done',         # job completed successfully
     'failed',       # some error occurred,
     'paused',       # job paused.  can't think when this would be useful...
 ]
 
+LEASE_STATES = ['queued', 'running']    # states in which a processor holds a lease on the job
+FINAL_STATES = ['done', 'failed']
+RETRY_BACKOFF = 60                      # seconds before the first retry, doubling with each retry...
+MAX_RETRY_BACKOFF = 3600                # ...up to this
+MAX_WAIT = 60                           # longest long-poll of /jobs/next, in seconds
+DEFAULT_LIMIT = 100                     # page size of /jobs...
+MAX_LIMIT = 1000                        # ...and its maximum
+
+STATS_BREAKDOWNS = {
+    'group': '$group',
+    'project': '$project._id',
+    'app': '$app._id',
+}
+
+# by -> counts, shared by all requests of this process
+stats_cache = util.LRUCache(16)
+
 # Jobs must now how they affect the various components of a file description
 # some "special" case things will reset state from 'orig' to 'pending'
 # but the usual case will be to append an item to the state list.
@@ -44,15 +69,22 @@ class Jobs(base.RequestHandler):
 
     def get(self):
         """
-        Return one Job that needs processing.
-
-        TODO: allow querying for group
-        TODO: allow querying for project
-        TODO: allow querying by other meta data. can this be generalized?
+        Return jobs, newest first, optionally filtered by status, group, project and app.
 
+        Paginate with limit (1 to MAX_LIMIT) and skip.
         """
         # TODO: auth
-        return list(self.app.db.jobs.find())
+        query = self._filter(self.request.GET)
+        if self.request.GET.get('status'):
+            query['status'] = self.request.GET['status']
+        try:
+            limit = min(max(int(self.request.GET.get('limit', DEFAULT_LIMIT)), 1), MAX_LIMIT) # limit(0) would mean no limit
+            skip = int(self.request.GET.get('skip', 0))
+        except ValueError as e:
+            self.abort(400, str(e))
+        if skip < 0:
+            self.abort(400, 'skip must not be negative')
+        return list(self.app.db.jobs.find(query).sort('_id', -1).skip(skip).limit(limit))
 
     def count(self):
         """Return the total number of jobs."""
@@ -60,45 +92,167 @@ class Jobs(base.RequestHandler):
         return self.app.db.jobs.count()
 
     def counts(self):
-        """Return more information about the jobs."""
-        counts = {
-            'total': self.app.db.jobs.count(),
-            'failed': self.app.db.jobs.find({'status': 'failed'}).count(),
-            'pending': self.app.db.jobs.find({'status': 'pending'}).count(),
-            'done': self.app.db.jobs.find({'status': 'done'}).count(),
-        }
+        """
+        Return the number of jobs by status, and the number of expired leases.
+
+        by=group,project,app adds the same breakdown per group, project or app. Results
+        are computed with one aggregation per breakdown, and cached for job_stats_ttl seconds.
+        """
+        by = tuple(sorted(set(b for b in self.request.GET.get('by', '').split(',') if b)))
+        if set(by) - set(STATS_BREAKDOWNS):
+            self.abort(400, 'by must be a list of %s' % ', '.join(STATS_BREAKDOWNS))
+        counts = stats_cache.get(by)
+        if counts is None:
+            counts = dict((state, 0) for state in JOB_STATES)
+            for r in self.app.db.jobs.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+                counts[r['_id']] = r['count']
+            counts['total'] = sum(counts[state] for state in counts)
+            lease_expiries = self.app.db.counters.find_one({'_id': 'job_lease_expiries'})
+            counts['lease_expiries'] = lease_expiries['seq'] if lease_expiries else 0
+            for breakdown in by:
+                counts['by_' + breakdown] = breakdown_counts = {}
+                pipeline = [{'$group': {'_id': {'key': STATS_BREAKDOWNS[breakdown], 'status': '$status'}, 'count': {'$sum': 1}}}]
+                for r in self.app.db.jobs.aggregate(pipeline):
+                    breakdown_counts.setdefault(str(r['_id'].get('key')), {})[r['_id']['status']] = r['count']
+            stats_cache.put(by, counts, ttl=self.app.config['job_stats_ttl'])
         return counts
 
-    def next(self):
-        """Return the next job in the queue that matches the query parameters."""
-        # TODO: add ability to query on things like psd type or psd name
+    def latency(self):
+        """
+        Return the distributions of wait and run times per app, in seconds.
+
+        Covers the jobs that finished in the last `hours` [24]. Wait time runs from creation
+        to the last claim, run time from the first running heartbeat (or else the claim) to
+        completion. Each distribution has percentiles and a histogram of power-of-two buckets,
+        keyed by their upper bound.
+        """
         try:
-            query_params = self.request.json
+            hours = float(self.request.GET.get('hours', 24))
         except ValueError as e:
             self.abort(400, str(e))
+        query = self._filter(self.request.GET)
+        query['finished'] = {'$gte': datetime.datetime.utcnow() - datetime.timedelta(hours=hours)}
+        times = {}
+        for job in self.app.db.jobs.find(query, ['app', 'created', 'claimed', 'started', 'finished']):
+            app_times = times.setdefault(job['app']['_id'], {'wait': [], 'run': []})
+            if job.get('claimed') and job.get('created'):
+                app_times['wait'].append((job['claimed'] - job['created']).total_seconds())
+            if job.get('started', job.get('claimed')):
+                app_times['run'].append((job['finished'] - job.get('started', job.get('claimed'))).total_seconds())
+        return dict((app_id, {'wait': _distribution(t['wait']), 'run': _distribution(t['run'])}) for app_id, t in times.iteritems())
+
+    def _filter(self, query_params):
+        query = {}
+        if query_params.get('group'):
+            query['group'] = query_params['group']
+        if query_params.get('project'):
+            try:
+                query['project._id'] = bson.ObjectId(query_params['project'])
+            except bson.errors.InvalidId as e:
+                self.abort(400, str(e))
+        if query_params.get('app'):
+            query['app._id'] = query_params['app']
+        return query
 
-        query = {'status': 'pending'}
+    def next(self):
+        """
+        Claim the next job in the queue that matches the query parameters.
+
+        Jobs are handed out by descending priority, then oldest first. Optional group
+        and project filters can be given as query parameters or in a JSON body.
+        The claim is a lease, which the processor extends by updating the job with
+        the claim token of the returned job.
+
+        With n, up to n (at most MAX_LIMIT) jobs are claimed and returned as a list.
+        With wait, the request blocks for up to that many seconds until a matching
+        job is queued.
+        """
+        # TODO: add ability to query on things like psd type or psd name
+        query_params = dict(self.request.GET.items())
+        if self.request.body:
+            try:
+                query_params.update(self.request.json)
+            except ValueError as e:
+                self.abort(400, str(e))
         try:
-            query_params = self.request.json
+            n = min(int(query_params.get('n', 0)), MAX_LIMIT)
+            wait = min(float(query_params.get('wait', 0)), MAX_WAIT)
         except ValueError as e:
             self.abort(400, str(e))
+        if n < 0:
+            self.abort(400, 'n must not be negative')
+
+        query = self._filter(query_params)
+        query['status'] = 'pending'
 
-        project_query = query_params.get('project')
-        group_query = query_params.get('group')
-        query = {'status': 'pending'}
-        if project_query:
-            query.update({'project': project_query})
-        if group_query:
-            query.update({'group': group_query})
+        deadline = time.time() + wait
+        last_event = self.app.db.job_events.find_one(sort=[('$natural', -1)]) # read before claiming, so that no insert is missed
+        jobs = self._claim(query, max(n, 1))
+        while not jobs and time.time() < deadline:
+            last_event = _wait_for_job_event(self.app.db, last_event, deadline)
+            jobs = self._claim(query, max(n, 1))
+        if n:
+            return jobs
+        return jobs[0] if jobs else None
+
+    def _claim(self, query, n):
+        # served from the (status, [group | project._id,] priority, created) indexes
+        now = datetime.datetime.utcnow()
+        # the claim token identifies this claim in heartbeats, see Job.put
+        claim = {'status': 'queued', 'modified': now, 'claimed': now, 'lease_expires': now + datetime.timedelta(seconds=self.app.config['job_lease']), 'claim': str(uuid.uuid4())}
+        if n == 1:
+            job_spec = self.app.db.jobs.find_one_and_update(
+                query,
+                {'$set': claim},
+                sort=[('priority', -1), ('created', 1)],
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+            return [job_spec] if job_spec else []
+        # candidates that a concurrent claim takes first are skipped, as the update requires them to be pending
+        candidates = [j['_id'] for j in self.app.db.jobs.find(query, ['_id']).sort([('priority', -1), ('created', 1)]).limit(n)]
+        if not candidates:
+            return []
+        self.app.db.jobs.update_many(dict(query, _id={'$in': candidates}), {'$set': claim})
+        return list(self.app.db.jobs.find({'_id': {'$in': candidates}, 'claim': claim['claim']}).sort([('priority', -1), ('created', 1)]))
+
+
+def _distribution(values):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    percentile = lambda p: values[min(int(p / 100. * len(values)), len(values) - 1)]
+    histogram = {}
+    for v in values:
+        bucket = 2 ** int(math.ceil(math.log(v, 2))) if v > 1 else 1
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'max': values[-1],
+        'histogram': histogram,
+    }
 
-        # TODO: how to guarantee the 'oldest' jobs pending jobs are given out first
-        job_spec = self.app.db.jobs.find_and_modify(
-            query,
-            {'$set': {'status': 'queued', 'modified': datetime.datetime.now()}},
-            sort=[('modified', -1)],
-            new=True
-        )
-        return job_spec
+
+def _wait_for_job_event(db, last_event, deadline):
+    """
+    Block until a job is queued after last_event, or until the deadline; return the newest event seen.
+
+    Job events are tailed from a capped collection. Without one, fall back to polling.
+    """
+    spec = {'_id': {'$gt': last_event['_id']}} if last_event else {}
+    try:
+        cursor = db.job_events.find(spec, cursor_type=pymongo.CursorType.TAILABLE_AWAIT, max_await_time_ms=1000)
+        while cursor.alive and time.time() < deadline:
+            for event in cursor:
+                return event
+    except pymongo.errors.OperationFailure: # job_events is not capped, see dbinit
+        pass
+    time.sleep(max(min(1., deadline - time.time()), 0))
+    return last_event
 
 
 class Job(base.RequestHandler):
@@ -124,7 +278,67 @@ class Job(base.RequestHandler):
         return self.app.db.jobs.find_one({'_id': int(_id)})
 
     def put(self, _id):
-        """Update a single job."""
+        """
+        Update a single job held by a processor, renewing the lease while it is queued or running.
+
+        Updates of jobs that are no longer queued or running, or that were claimed again, if the
+        processor sends the claim token it received, are rejected with 409 Conflict.
+        """
         payload = self.request.json
         # TODO: validate the json before updating the db
-        self.app.db.jobs.update({'_id': int(_id)}, {'$set': {'status': payload.get('status'), 'activity': payload.get('activity')}})
+        now = datetime.datetime.utcnow()
+        update = {'$set': {'status': payload.get('status'), 'activity': payload.get('activity'), 'modified': now}}
+        if payload.get('status') in LEASE_STATES:
+            update['$set']['lease_expires'] = now + datetime.timedelta(seconds=self.app.config['job_lease'])
+        else:
+            update['$unset'] = {'lease_expires': True}
+        if payload.get('status') == 'running':
+            update['$min'] = {'started': now} # first heartbeat in this state
+        elif payload.get('status') in FINAL_STATES:
+            update['$set']['finished'] = now
+        query = {'_id': int(_id), 'status': {'$in': LEASE_STATES}}
+        if payload.get('claim'):
+            query['claim'] = payload['claim']
+        if not self.app.db.jobs.update_one(query, update).matched_count:
+            if not self.app.db.jobs.find_one({'_id': int(_id)}, ['_id']):
+                self.abort(404, 'no such job')
+            self.abort(409, 'job is no longer held by this processor')
+
+
+def reap_expired_leases(db, max_retries):
+    """
+    Return jobs whose processor stopped renewing its lease to the queue.
+
+    Expired jobs wait in 'retrying' with exponential backoff, and fail after max_retries.
+    Jobs whose backoff has passed are made pending again.
+    """
+    now = datetime.datetime.utcnow()
+    expired = 0
+    for job in db.jobs.find({'status': {'$in': LEASE_STATES}, 'lease_expires': {'$lt': now}}, ['status', 'lease_expires', 'retries']):
+        retries = job.get('retries', 0) + 1
+        if retries > max_retries:
+            update = {
+                '$set': {'status': 'failed', 'activity': 'lease expired %d times' % retries, 'modified': now, 'finished': now},
+                '$unset': {'lease_expires': True},
+            }
+        else:
+            backoff = min(RETRY_BACKOFF * 2 ** (retries - 1), MAX_RETRY_BACKOFF)
+            update = {
+                '$set': {'status': 'retrying', 'retry_at': now + datetime.timedelta(seconds=backoff), 'modified': now},
+                '$unset': {'lease_expires': True, 'claim': True, 'claimed': True, 'started': True}, # the failed attempt
+            }
+        update['$set']['retries'] = retries
+        # matching on the lease, so that a heartbeat that just came in wins
+        r = db.jobs.update_one({'_id': job['_id'], 'status': job['status'], 'lease_expires': job['lease_expires']}, update)
+        if r.modified_count:
+            expired += 1
+            log.warning('lease of job %d expired in state %s (retry %d)' % (job['_id'], job['status'], retries))
+    if expired:
+        db.counters.update_one({'_id': 'job_lease_expiries'}, {'$inc': {'seq': expired}}, upsert=True)
+    r = db.jobs.update_many(
+            {'status': 'retrying', 'retry_at': {'$lte': now}},
+            {'$set': {'status': 'pending', 'modified': now}, '$unset': {'retry_at': True}},
+            )
+    if r.modified_count:
+        db.job_events.insert_one({'job': None, 'timestamp': now}) # wake up long-polling processors
+    return expired
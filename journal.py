@@ -0,0 +1,225 @@
+"""
+Write-ahead journal for sorted file commits.
+
+util.commit_file appends a record for every file before moving it into the data
+path and writing its DB entry, and waits for that record to be on disk. Records
+of concurrent commits are made durable by a single fsync (group commit). The
+sorted files themselves are synced lazily, when a journal segment is
+checkpointed; in a background thread, or by the committing thread where
+uwsgi runs without threads. Segments left behind by dead processes are replayed by
+util.recover_commits.
+"""
+
+import logging
+log = logging.getLogger('scitran.api')
+
+import os
+import json
+import time
+import errno
+import threading
+import bson.json_util
+
+import util
+
+SEGMENT_RECORDS = 10000     # rotate segments after this many records...
+SEGMENT_SECONDS = 60        # ...or after this many seconds
+
+
+def _background_threads():
+    """Under uwsgi, threads started by the app only run with --enable-threads (or --threads)."""
+    try:
+        import uwsgi
+    except ImportError:
+        return True
+    return bool(uwsgi.opt.get('enable-threads') or uwsgi.opt.get('threads'))
+
+
+def _fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sync_files(filepaths):
+    """fsync files and, once each, their directories."""
+    dirpaths = set()
+    for filepath in filepaths:
+        _fsync_path(filepath)
+        dirpaths.add(os.path.dirname(filepath))
+    for dirpath in dirpaths:
+        _fsync_path(dirpath)
+
+
+def read_segment(segment_path):
+    """Yield the records of a segment, ignoring a torn last line."""
+    with open(segment_path) as fd:
+        for line in fd:
+            try:
+                yield json.loads(line, object_hook=bson.json_util.object_hook)
+            except ValueError:
+                log.warning('ignoring torn record in %s' % segment_path)
+
+
+def orphaned_segments(journal_path):
+    """Return the segments written on this node by processes that no longer exist, oldest first."""
+    segments = []
+    for fn in os.listdir(journal_path):
+        try:
+            host, pid, started, n = fn[:-len('.log')].rsplit('_', 3)
+            pid, started, n = int(pid), int(started), int(n)
+        except ValueError:
+            continue
+        # a process that started after the segment reused the pid, possibly this one
+        if host == util.node_id and not util.pid_alive(pid, started):
+            segments.append((started, pid, n, os.path.join(journal_path, fn)))
+    return [s[-1] for s in sorted(segments)]
+
+
+class CommitJournal(object):
+
+    """Append-only, segmented journal of one process."""
+
+    def __init__(self, journal_path):
+        if not os.path.exists(journal_path):
+            os.makedirs(journal_path)
+        self.journal_path = journal_path
+        self.pid = os.getpid()
+        self._prefix = os.path.join(journal_path, '%s_%d_%d' % (util.node_id, self.pid, int(time.time())))
+        self._cond = threading.Condition(threading.Lock())
+        self._seq = 0           # last appended record
+        self._synced_seq = 0    # last durable record
+        self._syncing = False   # an fsync is in progress, on behalf of all waiting committers
+        self._segment = 0
+        self._closed_segments = []  # (path, last seq)
+        self._inflight = set()      # commits begun, but not ended
+        self._checkpointing = False
+        self._checkpoint_due = False    # checkpoint in end(), where background threads do not run
+        self._checkpoint_lock = threading.Lock()
+        self.closed = False
+        self._open_segment()
+
+    def _open_segment(self):
+        self._segment += 1
+        self._segment_path = '%s_%d.log' % (self._prefix, self._segment)
+        self._fd = os.open(self._segment_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        self._segment_records = 0
+        self._segment_opened = time.time()
+
+    def _rotate(self):
+        """Close the current segment and checkpoint closed segments in the background; caller holds the lock."""
+        while self._syncing:
+            self._cond.wait()
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._synced_seq = self._seq
+        self._closed_segments.append((self._segment_path, self._seq))
+        self._open_segment()
+        if not self._checkpointing:
+            self._checkpointing = True
+            if _background_threads():
+                thread = threading.Thread(target=self.checkpoint, name='journal-checkpoint')
+                thread.daemon = True
+                thread.start()
+            else:
+                self._checkpoint_due = True
+
+    def _append(self, record):
+        """Append a record, without waiting for it to become durable; caller holds the lock."""
+        if self._segment_records and (self._segment_records >= SEGMENT_RECORDS or time.time() - self._segment_opened >= SEGMENT_SECONDS):
+            self._rotate()
+        self._seq += 1
+        record['seq'] = self._seq
+        os.write(self._fd, json.dumps(record, default=bson.json_util.default) + '\n')
+        self._segment_records += 1
+        return self._seq
+
+    def begin(self, **record):
+        """Durably record the start of a commit; return its sequence number."""
+        record['op'] = 'commit'
+        with self._cond:
+            seq = self._append(record)
+            self._inflight.add(seq)
+        self.sync(seq)
+        return seq
+
+    def end(self, seq):
+        """Record the end of a commit. Lazily durable, as recovery of a completed commit is idempotent."""
+        with self._cond:
+            self._append({'op': 'done', 'commit': seq})
+            self._inflight.discard(seq)
+            checkpoint_due, self._checkpoint_due = self._checkpoint_due, False
+        if checkpoint_due:
+            self.checkpoint()
+
+    def sync(self, seq):
+        """Block until record seq is durable. One caller fsyncs for all records appended so far."""
+        with self._cond:
+            while self._synced_seq < seq:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                target, fd = self._seq, self._fd
+                self._cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self._synced_seq = max(self._synced_seq, target)
+
+    def checkpoint(self):
+        """Sync the files committed in closed segments, then discard those segments."""
+        with self._checkpoint_lock:
+            try:
+                while True:
+                    with self._cond:
+                        # a segment with commits in flight is kept until a later checkpoint
+                        if not self._closed_segments or min(self._inflight or [self._seq + 1]) <= self._closed_segments[0][1]:
+                            self._checkpointing = False
+                            return
+                        segment_path = self._closed_segments[0][0]
+                    sync_files(set(r['path'] for r in read_segment(segment_path) if r['op'] == 'commit'))
+                    os.remove(segment_path)
+                    with self._cond:
+                        self._closed_segments.pop(0)
+            except Exception:
+                log.exception('journal checkpoint failed')
+                with self._cond:
+                    self._checkpointing = False
+
+    def close(self):
+        """Close the journal and checkpoint it synchronously, e.g. at the end of a batch run."""
+        with self._cond:
+            while self._syncing:
+                self._cond.wait()
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._synced_seq = self._seq
+            if self._segment_records:
+                self._closed_segments.append((self._segment_path, self._seq))
+            else:
+                os.remove(self._segment_path)
+            self.closed = True
+        self.checkpoint()
+
+
+_journals = {}
+_journals_lock = threading.Lock()
+
+def get_journal(journal_path):
+    """Return the journal of this process, opening a new one after a fork."""
+    with _journals_lock:
+        journal = _journals.get(journal_path)
+        if journal is None or journal.closed or journal.pid != os.getpid():
+            journal = _journals[journal_path] = CommitJournal(journal_path)
+        return journal
@@ -0,0 +1,203 @@
+"""
+Montage tile serving.
+
+Encoded tiles are cached in memory and, optionally, on disk. Cache keys are
+built from the montage's content hash and z/x/y, so entries never go stale;
+a replaced montage simply gets new keys.
+
+Tiles that are not cached are read from a pool of open montage zips, whose
+central directory is parsed once into a table of tile members.
+
+To speed up first views, the lowest zoom levels of new montages can be
+prerendered into the disk cache by the ingest workers, and the neighbours
+and children of requested tiles are prefetched in the background.
+"""
+
+import logging
+log = logging.getLogger('scitran.api')
+
+import os
+import re
+import errno
+import zipfile
+import time
+import Queue
+import tempfile
+import threading
+
+import util
+
+TILE_MEMBER_RE = re.compile(r'z(\d+)/x(\d+)_y(\d+)\.\w+$')
+
+# tile key -> encoded tile, per process; api.wsgi sets maxsize from --tile_cache_size
+tile_cache = util.LRUCache(2048)
+
+# (path, mtime) -> MontageArchive, per process; evicted archives are closed once no request uses them
+archive_pool = util.LRUCache(32)
+
+PREFETCH_WINDOW = 10            # seconds over which a montage's prefetch budget is spent
+
+# filehash -> [window start, tiles prefetched in window]
+_prefetch_budgets = util.LRUCache(256)
+_prefetch_queue = Queue.Queue(maxsize=1024)
+_prefetch_lock = threading.Lock()
+_prefetch_pid = None
+
+
+class MontageArchive(object):
+
+    """An open montage zip, with a table of its tile members."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._zf = zipfile.ZipFile(open(filepath, 'rb'))
+        self._lock = threading.Lock() # members are read through one shared file object
+        self._info = None
+        self.members = {}
+        for zi in self._zf.infolist():
+            match = TILE_MEMBER_RE.search(zi.filename)
+            if match:
+                self.members[tuple(int(g) for g in match.groups())] = zi
+
+    def info(self):
+        if self._info is None:
+            self._info = util.get_info(self.filepath)
+        return self._info
+
+    def read(self, z, x, y):
+        """Return an encoded tile, seeking directly to its member; None if it does not exist."""
+        if not self.members: # unknown member naming, leave it to scitran.data
+            return util.get_tile(self.filepath, z, x, y)
+        zi = self.members.get((z, x, y))
+        if zi is None:
+            return None
+        with self._lock:
+            return self._zf.read(zi)
+
+
+def get_archive(filepath):
+    key = (filepath, os.path.getmtime(filepath))
+    archive = archive_pool.get(key)
+    if archive is None:
+        archive = MontageArchive(filepath)
+        archive_pool.put(key, archive)
+    return archive
+
+
+def get_info(filepath):
+    """Return the info of a montage, computed once per process."""
+    return get_archive(filepath).info()
+
+
+def tile_key(filehash, z, x, y):
+    return '%s/%d/%d/%d' % (filehash, z, x, y)
+
+
+def _disk_path(cache_path, key):
+    filehash, z, x, y = key.split('/')
+    return os.path.join(cache_path, filehash[:2], filehash, '%s_%s_%s.jpg' % (z, x, y))
+
+
+def _read_disk(cache_path, key):
+    try:
+        with open(_disk_path(cache_path, key), 'rb') as fd:
+            return fd.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _write_disk(cache_path, key, tile):
+    filepath = _disk_path(cache_path, key)
+    dirpath = os.path.dirname(filepath)
+    if not os.path.exists(dirpath):
+        try:
+            os.makedirs(dirpath)
+        except OSError as e:
+            if e.errno != errno.EEXIST: # created concurrently
+                raise
+    fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=dirpath)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(tile)
+    os.rename(tmp_path, filepath) # atomic, concurrent readers never see partial tiles
+
+
+def get_tiles(filepath, filehash, zxys, cache_path=None):
+    """
+    Return encoded tiles, from memory, from the disk cache, or decoded from the montage.
+
+    Tiles that do not exist are None. The montage is checked out of the pool at most once.
+    """
+    archive = None
+    tiles = []
+    for z, x, y in zxys:
+        key = tile_key(filehash, z, x, y)
+        tile = tile_cache.get(key)
+        if tile is None:
+            if cache_path:
+                tile = _read_disk(cache_path, key)
+            if tile is None:
+                archive = archive or get_archive(filepath)
+                tile = archive.read(z, x, y)
+                if tile and cache_path:
+                    _write_disk(cache_path, key, tile)
+            if tile:
+                tile_cache.put(key, tile)
+        tiles.append(tile)
+    return tiles
+
+
+def get_tile(filepath, filehash, z, x, y, cache_path=None):
+    """Return an encoded tile; None if it does not exist."""
+    return get_tiles(filepath, filehash, [(z, x, y)], cache_path)[0]
+
+
+def prerender(filepath, filehash, levels, cache_path):
+    """Write the tiles of the lowest zoom levels into the disk cache; return their number."""
+    zxys = sorted(zxy for zxy in get_archive(filepath).members if zxy[0] < levels)
+    get_tiles(filepath, filehash, zxys, cache_path)
+    return len(zxys)
+
+
+def prefetch(filepath, filehash, z, x, y, budget, cache_path=None):
+    """
+    Queue the neighbours of a tile and its children at the next zoom level for background decoding.
+
+    At most budget tiles are prefetched per montage and PREFETCH_WINDOW; prefetching never delays requests.
+    """
+    zxys = [(z, x - 1, y), (z, x + 1, y), (z, x, y - 1), (z, x, y + 1)]
+    zxys += [(z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]
+    zxys = [zxy for zxy in zxys if min(zxy) >= 0 and tile_cache.get(tile_key(filehash, *zxy)) is None]
+    with _prefetch_lock:
+        now = time.time()
+        spent = _prefetch_budgets.get(filehash)
+        if spent is None or spent[0] + PREFETCH_WINDOW < now:
+            spent = [now, 0]
+            _prefetch_budgets.put(filehash, spent)
+        zxys = zxys[:max(budget - spent[1], 0)]
+        spent[1] += len(zxys)
+        _start_prefetcher()
+    if zxys:
+        try:
+            _prefetch_queue.put_nowait((filepath, filehash, zxys, cache_path))
+        except Queue.Full:
+            pass
+
+
+def _start_prefetcher():
+    """Start the prefetch thread of this process, e.g. after a fork; caller holds _prefetch_lock."""
+    global _prefetch_pid
+    if _prefetch_pid != os.getpid():
+        thread = threading.Thread(target=_prefetch_loop, name='tile-prefetch')
+        thread.daemon = True
+        thread.start()
+        _prefetch_pid = os.getpid()
+
+
+def _prefetch_loop():
+    while True:
+        filepath, filehash, zxys, cache_path = _prefetch_queue.get()
+        try:
+            get_tiles(filepath, filehash, zxys, cache_path)
+        except Exception:
+            log.exception('prefetching tiles of %s failed' % filepath)
@@ -197,6 +197,7 @@ class Groups(base.RequestHandler):
             json_body = self.request.json_body
             jsonschema.validate(json_body, Group.json_schema)
             self.dbc.insert(json_body)
+            util.bump_generation(self.app.db, 'groups')
         except (ValueError, jsonschema.ValidationError) as e:
             self.abort(400, str(e))
         except pymongo.errors.DuplicateKeyError as e:
@@ -302,6 +303,7 @@ class Group(base.RequestHandler):
         except (ValueError, jsonschema.ValidationError) as e:
             self.abort(400, str(e))
         self.dbc.update({'_id': _id}, {'$set': util.mongo_dict(json_body)})
+        util.bump_generation(self.app.db, 'groups')
 
     def delete(self, _id):
         """Delete an Group."""
@@ -311,3 +313,4 @@ class Group(base.RequestHandler):
         if project_ids:
             self.abort(400, 'group contains projects and cannot be deleted')
         self.dbc.delete_one({'_id': _id})
+        util.bump_generation(self.app.db, 'groups')
@@ -5,19 +5,32 @@ log = logging.getLogger('scitran.api')
 
 import os
 import bson
+import bson.json_util
 import copy
 import json
 import pytz
+import time
+import zlib
 import uuid
+import errno
+import struct
+import socket
 import shutil
 import difflib
 import hashlib
+import pymongo
+import pymongo.errors
 import tarfile
 import datetime
+import threading
+import collections
 import mimetypes
+import multiprocessing.pool
 import dateutil.parser
 import tempdir as tempfile
 
+import journal
+
 import scitran.data
 import scitran.data.medimg.montage
 
@@ -36,10 +49,70 @@ get_tile = scitran.data.medimg.montage.get_tile
 
 valid_timezones = pytz.all_timezones
 
+ARCHIVE_EXTENSIONS = {
+    'gzip': '.tgz',
+    'none': '.tar',
+}
+
+# identifies this node in journal segments and ingest claims, so that those of its dead processes
+# are recovered; api.wsgi sets it from --node_id, which must survive container recreation
+node_id = socket.gethostname()
+
 PROJECTION_FIELDS = ['group', 'timestamp', 'permissions', 'public']
 
+def _parser_version():
+    """Return the installed version of scitran.data; None if it cannot be determined."""
+    try:
+        import pkg_resources
+    except ImportError:
+        return None
+    for name in ['scitran.data', 'scitran-data']:
+        try:
+            return pkg_resources.get_distribution(name).version
+        except pkg_resources.DistributionNotFound:
+            pass
+
+PARSER_VERSION = _parser_version()
+if PARSER_VERSION is None:
+    log.warning('scitran.data version unknown -> parse cache disabled, as results could outlive parser upgrades')
+
+
+def parse_file(filepath, digest, cache=None):
+    """
+    Parse a file into datainfo, or return None if it is unparsable.
+
+    If cache is a collection, results are stored by SHA-1 and parser version, so that
+    resubmitting identical bytes skips the parser. The digest must be a real content hash.
+    Without a known parser version, nothing is cached.
+    """
+    if cache is not None and PARSER_VERSION:
+        key = '%s:%s' % (digest, PARSER_VERSION)
+        cached = cache.find_one({'_id': key})
+        if cached:
+            log.info('Cached      %s' % os.path.basename(filepath))
+            return _naive_datetimes(bson.json_util.loads(cached['datainfo']))
+        datainfo = _parse_file(filepath, digest)
+        cache.replace_one( # serialized, because metadata keys contain dots
+                {'_id': key},
+                {'_id': key, 'datainfo': bson.json_util.dumps(datainfo), 'timestamp': datetime.datetime.utcnow()},
+                upsert=True,
+                )
+        return datainfo
+    return _parse_file(filepath, digest)
+
 
-def parse_file(filepath, digest):
+def _naive_datetimes(obj):
+    """Undo the UTC tz-awareness that bson.json_util adds, so that cached and parsed datainfo compare equal."""
+    if isinstance(obj, dict):
+        return {k: _naive_datetimes(v) for k, v in obj.iteritems()}
+    elif isinstance(obj, list):
+        return [_naive_datetimes(v) for v in obj]
+    elif isinstance(obj, datetime.datetime) and obj.tzinfo is not None:
+        return obj.replace(tzinfo=None)
+    return obj
+
+
+def _parse_file(filepath, digest):
     filename = os.path.basename(filepath)
     try:
         log.info('Parsing     %s' % filename)
@@ -84,76 +157,355 @@ def quarantine_file(filepath, quarantine_path):
 
 
 def commit_file(dbc, _id, datainfo, filepath, data_path):
-    """Insert a file as an attachment or as a file."""
+    """
+    Insert a file as an attachment or as a file.
+
+    The commit is journaled, see journal.py. The file is moved into place before
+    its DB entry is written; if that write fails, the move is undone.
+    Returns the path of the committed file.
+    """
     filename = os.path.basename(filepath)
     fileinfo = datainfo['fileinfo']
     log.info('Sorting     %s' % filename)
-    if _id is None:
+    sorting = _id is None
+    if sorting:
         _id = _update_db(dbc.database, datainfo)
     container_path = os.path.join(data_path, str(_id)[-3:] + '/' + str(_id))
     if not os.path.exists(container_path):
         os.makedirs(container_path)
-    r = dbc.update_one({'_id':_id, 'files.filename': fileinfo['filename']}, {'$set': {'files.$': fileinfo}})
-    #TODO figure out if file was actually updated and return that fact
-    if r.matched_count != 1:
-        dbc.update({'_id': _id}, {'$push': {'files': fileinfo}})
-    shutil.move(filepath, container_path + '/' + fileinfo['filename'])
+    dest = container_path + '/' + fileinfo['filename']
+    replacing = os.path.exists(dest)
+    commit_journal = journal.get_journal(os.path.join(data_path, 'journal'))
+    seq = commit_journal.begin(collection=dbc.name, _id=_id, path=dest, fileinfo=fileinfo)
+    try:
+        shutil.move(filepath, dest)
+        try:
+            committed = _update_file_entry(dbc, _id, fileinfo)
+        except Exception:
+            if not replacing:
+                shutil.move(dest, filepath)
+            raise
+    finally:
+        commit_journal.end(seq)
+    if sorting and not committed: # stale hierarchy cache, e.g. deleted acquisition
+        hierarchy_cache.pop(datainfo['session_id'])
+        return commit_file(dbc, None, datainfo, dest, data_path)
     log.debug('Done        %s' % filename)
+    return dest
+
+
+def _update_file_entry(dbc, _id, fileinfo):
+    """Replace or append a file entry in one round trip; return False if the container does not exist."""
+    #TODO figure out if file was actually updated and return that fact
+    r = dbc.bulk_write([
+        pymongo.UpdateOne({'_id': _id, 'files.filename': fileinfo['filename']}, {'$set': {'files.$': fileinfo}}),
+        pymongo.UpdateOne({'_id': _id, 'files.filename': {'$ne': fileinfo['filename']}}, {'$push': {'files': fileinfo}}),
+    ])
+    return r.matched_count > 0
+
+
+def _in_place(filepath, fileinfo):
+    return os.path.isfile(filepath) and os.path.getsize(filepath) == fileinfo.get('filesize', os.path.getsize(filepath))
+
+
+def recover_commits(db, data_path):
+    """
+    Replay the commit journals of processes on this host that died.
+
+    Interrupted commits are redone if their file made it into place. Entries of
+    files that did not make it, or were torn by the crash, are removed and torn
+    files are quarantined.
+    """
+    journal_path = os.path.join(data_path, 'journal')
+    if not os.path.exists(journal_path):
+        return
+    for segment_path in journal.orphaned_segments(journal_path):
+        try:
+            records = list(journal.read_segment(segment_path))
+        except IOError: # recovered concurrently by another process
+            continue
+        done = set(r['commit'] for r in records if r['op'] == 'done')
+        in_place = []
+        redone = removed = 0
+        for r in records:
+            if r['op'] != 'commit':
+                continue
+            fileinfo = r['fileinfo']
+            if _in_place(r['path'], fileinfo):
+                in_place.append(r['path'])
+                if r['seq'] not in done:
+                    _update_file_entry(db[r['collection']], r['_id'], fileinfo)
+                    redone += 1
+            else:
+                res = db[r['collection']].update_one({'_id': r['_id']}, {'$pull': {'files': {'filename': fileinfo['filename'], 'filehash': fileinfo.get('filehash')}}})
+                removed += res.modified_count
+                if os.path.isfile(r['path']) and res.modified_count:
+                    log.warning('quarantining torn file %s' % r['path'])
+                    quarantine_file(r['path'], os.path.join(data_path, 'quarantine'))
+        journal.sync_files(in_place)
+        try:
+            os.remove(segment_path)
+        except OSError:
+            pass
+        log.info('recovered commit journal %s: %d commits redone, %d entries removed' % (os.path.basename(segment_path), redone, removed))
+
+
+def reconcile_files(db, data_path, quarantine_path=None):
+    """
+    Compare the files arrays of all containers with data_path; return the missing and the orphaned file paths.
+
+    With a quarantine_path, entries of missing files are removed and orphaned files are quarantined.
+    Files are moved into place before their entries are written, so this must not run concurrently with sorting.
+    """
+    known = set()
+    missing = []
+    for coll in ['projects', 'sessions', 'acquisitions', 'collections']:
+        for container in db[coll].find({'files': {'$exists': True, '$ne': []}}, ['files.filename']):
+            cid = str(container['_id'])
+            for f in container['files']:
+                filepath = os.path.join(data_path, cid[-3:], cid, f['filename'])
+                known.add(filepath)
+                if not os.path.isfile(filepath):
+                    missing.append(filepath)
+                    if quarantine_path:
+                        db[coll].update_one({'_id': container['_id']}, {'$pull': {'files': {'filename': f['filename']}}})
+    orphaned = []
+    for dirname in os.listdir(data_path):
+        if len(dirname) != 3: # skip upload, ingest, quarantine and journal
+            continue
+        for cid in os.listdir(os.path.join(data_path, dirname)):
+            container_path = os.path.join(data_path, dirname, cid)
+            for filename in os.listdir(container_path):
+                filepath = os.path.join(container_path, filename)
+                if filepath not in known:
+                    orphaned.append(filepath)
+                    if quarantine_path:
+                        quarantine_file(filepath, quarantine_path)
+    return missing, orphaned
+
+
+class LRUCache(object):
+
+    """Thread-safe, size-bounded LRU cache, with optional expiry of entries."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or (item[1] is not None and item[1] < time.time()):
+                return default
+            self._data[key] = item
+            return item[0]
+
+    def put(self, key, value, ttl=None):
+        """Store value; ttl overrides the cache's ttl, and a ttl of 0 disables caching."""
+        ttl = ttl if ttl is not None else self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            if ttl == 0:
+                return
+            self._data[key] = (value, time.time() + ttl if ttl is not None else None)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return item[0] if item else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# session uid -> project, session and acquisition ids and permissions, as last written by _update_db
+# short-lived, so that changes made through the API are picked up quickly
+hierarchy_cache = LRUCache(1024, ttl=30)
 
 
 def _update_db(db, datainfo):
+    """
+    Create or update the project, session and acquisition of a sorted file; return the acquisition id.
+
+    Files of the same acquisition arrive back-to-back. The resolved hierarchy is therefore cached,
+    and a container is only written again when its properties or the timestamp range change.
+    """
     #TODO: possibly try to keep a list of session IDs on the project, instead of having the session point to the project
     #      same for the session and acquisition
     #      queries might be more efficient that way
     session_spec = {'uid': datainfo['session_id']}
-    session = db.sessions.find_one(session_spec, ['project'])
-    if session: # skip project creation, if session exists
-        project = db.projects.find_one({'_id': session['project']}, projection=PROJECTION_FIELDS + ['name'])
-    else:
-        existing_group_ids = [g['_id'] for g in db.groups.find(None, ['_id'])]
-        group_id_matches = difflib.get_close_matches(datainfo['group_id'], existing_group_ids, cutoff=0.8)
-        if len(group_id_matches) == 1:
-            group_id = group_id_matches[0]
-            project_name = datainfo['project_name'] or 'untitled'
-        else:
-            group_id = 'unknown'
-            project_name = datainfo['group_id'] + ('/' + datainfo['project_name'] if datainfo['project_name'] else '')
-        group = db.groups.find_one({'_id': group_id})
-        project_spec = {'group': group['_id'], 'name': project_name}
-        project = db.projects.find_and_modify(
-                project_spec,
-                {'$setOnInsert': {'permissions': group['roles'], 'public': False, 'files': []}},
+    timestamp = datainfo['timestamp']
+    hierarchy = hierarchy_cache.get(datainfo['session_id'])
+    if hierarchy is None or hierarchy['session_properties'] != datainfo['session_properties']:
+        project = hierarchy['project'] if hierarchy else _resolve_project(db, datainfo)
+        session_update = {
+            '$setOnInsert': dict(group=project['group'], project=project['_id'], permissions=project['permissions'], public=project['public'], files=[]),
+            '$set': dict(datainfo['session_properties'] or session_spec), # session_spec ensures non-empty $set
+            #'$addToSet': {'modalities': datainfo['fileinfo']['modality']}, # FIXME
+            }
+        if timestamp:
+            session_update['$min'] = dict(timestamp=timestamp)
+            session_update['$set']['timezone'] = datainfo['timezone']
+        session = db.sessions.find_and_modify(
+                session_spec,
+                session_update,
                 upsert=True,
                 new=True,
-                projection=PROJECTION_FIELDS,
+                projection=PROJECTION_FIELDS + ['exam'], # exam for create_job
                 )
-    session = db.sessions.find_and_modify(
-            session_spec,
-            {
-                '$setOnInsert': dict(group=project['group'], project=project['_id'], permissions=project['permissions'], public=project['public'], files=[]),
-                '$set': datainfo['session_properties'] or session_spec, # session_spec ensures non-empty $set
-                #'$addToSet': {'modalities': datainfo['fileinfo']['modality']}, # FIXME
-                },
+        if timestamp:
+            db.projects.update_one({'_id': project['_id']}, {'$max': dict(timestamp=timestamp), '$set': dict(timezone=datainfo['timezone'])})
+        hierarchy = {
+            'project': project,
+            'session': session,
+            'session_properties': datainfo['session_properties'],
+            'acquisitions': {},
+            'timestamps': set([timestamp]),
+        }
+        hierarchy_cache.put(datainfo['session_id'], hierarchy)
+    elif timestamp and timestamp not in hierarchy['timestamps']:
+        db.projects.update_one({'_id': hierarchy['project']['_id']}, {'$max': dict(timestamp=timestamp), '$set': dict(timezone=datainfo['timezone'])})
+        db.sessions.update_one({'_id': hierarchy['session']['_id']}, {'$min': dict(timestamp=timestamp), '$set': dict(timezone=datainfo['timezone'])})
+        hierarchy['timestamps'].add(timestamp)
+    session = hierarchy['session']
+    acquisition = hierarchy['acquisitions'].get(datainfo['acquisition_id'])
+    if acquisition is None or acquisition['properties'] != datainfo['acquisition_properties']:
+        acquisition_spec = {'uid': datainfo['acquisition_id']}
+        acquisition = db.acquisitions.find_and_modify(
+                acquisition_spec,
+                {
+                    '$setOnInsert': dict(session=session['_id'], permissions=session['permissions'], public=session['public'], files=[]),
+                    '$set': datainfo['acquisition_properties'] or acquisition_spec, # acquisition_spec ensures non-empty $set
+                    #'$addToSet': {'types': {'$each': [{'domain': dataset.nims_file_domain, 'kind': kind} for kind in dataset.nims_file_kinds]}},
+                    },
+                upsert=True,
+                new=True,
+                projection=[],
+                )
+        acquisition['properties'] = datainfo['acquisition_properties']
+        hierarchy['acquisitions'][datainfo['acquisition_id']] = acquisition
+    return acquisition['_id']
+
+
+def _resolve_project(db, datainfo):
+    session = db.sessions.find_one({'uid': datainfo['session_id']}, ['project'])
+    if session: # skip project creation, if session exists
+        return db.projects.find_one({'_id': session['project']}, projection=PROJECTION_FIELDS + ['name'])
+    group_id_matches = match_group_id(db, datainfo['group_id'], cutoff=0.8)
+    if len(group_id_matches) == 1:
+        group_id = group_id_matches[0]
+        project_name = datainfo['project_name'] or 'untitled'
+    else:
+        group_id = 'unknown'
+        project_name = datainfo['group_id'] + ('/' + datainfo['project_name'] if datainfo['project_name'] else '')
+    group = db.groups.find_one({'_id': group_id})
+    project_spec = {'group': group['_id'], 'name': project_name}
+    return db.projects.find_and_modify(
+            project_spec,
+            {'$setOnInsert': {'permissions': group['roles'], 'public': False, 'files': []}},
             upsert=True,
             new=True,
-            projection=PROJECTION_FIELDS,
+            projection=PROJECTION_FIELDS + ['name'],
             )
-    acquisition_spec = {'uid': datainfo['acquisition_id']}
-    acquisition = db.acquisitions.find_and_modify(
-            acquisition_spec,
-            {
-                '$setOnInsert': dict(session=session['_id'], permissions=session['permissions'], public=session['public'], files=[]),
-                '$set': datainfo['acquisition_properties'] or acquisition_spec, # acquisition_spec ensures non-empty $set
-                #'$addToSet': {'types': {'$each': [{'domain': dataset.nims_file_domain, 'kind': kind} for kind in dataset.nims_file_kinds]}},
-                },
+
+
+def _trigrams(word):
+    padded = '\0\0' + word + '\0\0'
+    return set(padded[i:i+3] for i in range(len(padded) - 2))
+
+
+class GroupIndex(object):
+
+    """
+    In-memory trigram index of group IDs for fuzzy matching.
+
+    match() only scores IDs that share a padded trigram with the word. For cutoffs of at
+    least MIN_CUTOFF, this returned what difflib.get_close_matches returns for the full list
+    of IDs in randomized checks; at lower cutoffs, close IDs sharing no trigram are missed,
+    so those are rejected. Results are memoized until the index is rebuilt.
+    """
+
+    MIN_CUTOFF = 0.8
+
+    def __init__(self):
+        self.generation = None
+        self._grams = {}
+        self._matches = {}
+        self._lock = threading.Lock()
+
+    def build(self, group_ids, generation):
+        grams = {}
+        for group_id in group_ids:
+            for gram in _trigrams(group_id):
+                grams.setdefault(gram, set()).add(group_id)
+        with self._lock:
+            self._grams, self._matches, self.generation = grams, {}, generation
+
+    def match(self, word, n=3, cutoff=MIN_CUTOFF):
+        if cutoff < self.MIN_CUTOFF:
+            raise ValueError('cutoff must be at least %s' % self.MIN_CUTOFF)
+        key = (word, n, cutoff)
+        matches = self._matches.get(key)
+        if matches is None:
+            candidates = set()
+            for gram in _trigrams(word):
+                candidates.update(self._grams.get(gram, ()))
+            matches = self._matches[key] = difflib.get_close_matches(word, candidates, n, cutoff)
+        return list(matches)
+
+
+group_index = GroupIndex()
+
+
+def match_group_id(db, word, n=3, cutoff=GroupIndex.MIN_CUTOFF):
+    """Fuzzy-match word against all group IDs, rebuilding the index if groups have changed."""
+    generation = get_generation(db, 'groups')
+    if generation != group_index.generation:
+        group_index.build([g['_id'] for g in db.groups.find(None, ['_id'])], generation)
+    return group_index.match(word, n, cutoff)
+
+
+def next_sequence(db, name):
+    """Atomically allocate the next value of a counter."""
+    counter = db.counters.find_one_and_update(
+            {'_id': name},
+            {'$inc': {'seq': 1}},
             upsert=True,
-            new=True,
-            projection=[],
+            return_document=pymongo.ReturnDocument.AFTER,
             )
-    if datainfo['timestamp']:
-        db.projects.update({'_id': project['_id']}, {'$max': dict(timestamp=datainfo['timestamp']), '$set': dict(timezone=datainfo['timezone'])})
-        db.sessions.update({'_id': session['_id']}, {'$min': dict(timestamp=datainfo['timestamp']), '$set': dict(timezone=datainfo['timezone'])})
-    return acquisition['_id']
+    return counter['seq']
+
+
+def seed_job_counter(db):
+    """Advance the job id counter past all existing jobs."""
+    last_job = db.jobs.find_one({}, ['_id'], sort=[('_id', -1)])
+    db.counters.update_one({'_id': 'jobs'}, {'$max': {'seq': last_job['_id'] if last_job else 0}}, upsert=True)
+
+
+# (db name, collection) -> generation; changes made by other processes are seen within the ttl
+generation_cache = LRUCache(64, ttl=5)
+
+
+def get_generation(db, name):
+    """Return the change counter of a collection that other processes cache in memory."""
+    key = (db.name, name)
+    generation = generation_cache.get(key)
+    if generation is None:
+        counter = db.counters.find_one({'_id': name + '_generation'})
+        generation = counter['seq'] if counter else 0
+        generation_cache.put(key, generation)
+    return generation
+
+
+def bump_generation(db, name):
+    """Invalidate in-memory caches of a collection in all processes; immediately in this one."""
+    db.counters.update_one({'_id': name + '_generation'}, {'$inc': {'seq': 1}}, upsert=True)
+    generation_cache.pop((db.name, name))
 
 
 def _entity_metadata(dataset, properties, metadata={}, parent_key=''):
@@ -171,26 +523,69 @@ def _entity_metadata(dataset, properties, metadata={}, parent_key=''):
 
 
 # TODO: create job should be use-able from bootstrap.py with only database information
+def _rule_key(type_, state, kinds):
+    hashable = lambda v: tuple(v) if isinstance(v, list) else v
+    return (type_, hashable(state), hashable(kinds))
+
+
+class AppIndex(object):
+
+    """
+    In-memory index of the inputs of default apps, keyed on (type, state, kinds).
+
+    find() returns what querying db.apps for a default app with a matching input, or with
+    a kinds: None input of the same type and state, would return: the first such app in
+    natural order. Apps are returned as copies, as create_job modifies them.
+    """
+
+    def __init__(self):
+        self.generation = None
+        self._index = ([], {})
+
+    def build(self, apps, generation):
+        rules = {}
+        for i, app in enumerate(apps):
+            for input_ in app.get('inputs', []):
+                rules.setdefault(_rule_key(input_.get('type'), input_.get('state'), input_.get('kinds')), i)
+        self._index, self.generation = (apps, rules), generation
+
+    def find(self, type_, state, kinds):
+        apps, rules = self._index
+        hits = [rules.get(_rule_key(type_, state, kinds)), rules.get(_rule_key(type_, state, None))]
+        hits = [i for i in hits if i is not None]
+        return copy.deepcopy(apps[min(hits)]) if hits else None
+
+app_index = AppIndex()
+
+
+def find_default_app(db, type_, state, kinds):
+    """Return the default app for an input, rebuilding the index if apps have changed."""
+    generation = get_generation(db, 'apps')
+    if generation != app_index.generation:
+        app_index.build(list(db.apps.find({'default': True})), generation)
+    return app_index.find(type_, state, kinds)
+
+
 def create_job(dbc, datainfo):
     fileinfo = datainfo['fileinfo']
     db = dbc.database
     type_ = fileinfo['filetype']
     kinds_ = fileinfo['datatypes']
     state_ = ['orig'] # dataset.nims_file_state ### WHAT IS THIS AND WHY DO WE CARE?
-    app = None
     # TODO: check if there are 'default apps' set for this project/session/acquisition
-    acquisition = db.acquisitions.find_one({'uid': datainfo['acquisition_id']})
-    session = db.sessions.find_one({'_id': acquisition.get('session')})
-    project = db.projects.find_one({'_id': session.get('project')})
+    hierarchy = hierarchy_cache.get(datainfo.get('session_id'))
+    acquisition = hierarchy and hierarchy['acquisitions'].get(datainfo['acquisition_id'])
+    if acquisition: # just sorted, reuse what _update_db resolved
+        session = hierarchy['session']
+        project = hierarchy['project']
+    else:
+        acquisition = db.acquisitions.find_one({'uid': datainfo['acquisition_id']}, ['session'])
+        session = db.sessions.find_one({'_id': acquisition.get('session')}, ['project', 'exam'])
+        project = db.projects.find_one({'_id': session.get('project')}, ['group', 'name'])
     aid = acquisition.get('_id')
 
     # XXX: if an input kinds = None, then that job is meant to work on any file kinds
-    app = db.apps.find_one({
-        '$or': [
-            {'inputs': {'$elemMatch': {'type': type_, 'state': state_, 'kinds': kinds_}}, 'default': True},
-            {'inputs': {'$elemMatch': {'type': type_, 'state': state_, 'kinds': None}}, 'default': True},
-        ],
-    })
+    app = find_default_app(db, type_, state_, kinds_)
     # TODO: this has to move...
     # force acquisition dicom file to be marked as 'optional = True'
     db.acquisitions.find_and_modify(
@@ -208,46 +603,48 @@ def create_job(dbc, datainfo):
 
         # TODO: job description needs more metadata to be searchable in a useful way
         output_url = '%s/%s/%s' % ('acquisitions', aid, 'file')
-        job = db.jobs.find_and_modify(
-            {
-                '_id': db.jobs.count() + 1,
+        job = {
+            '_id': next_sequence(db, 'jobs'),
+            'group': project.get('group'),
+            'project': {
+                '_id': project.get('_id'),
+                'name': project.get('name'),
             },
-            {
-                '_id': db.jobs.count() + 1,
-                'group': project.get('group'),
-                'project': {
-                    '_id': project.get('_id'),
-                    'name': project.get('name'),
-                },
-                'exam': session.get('exam'),
-                'app': {
-                    '_id': app['_id'],
-                    'type': 'docker',
-                },
-                'inputs': [
-                    {
-                        'filename': fileinfo['filename'],
-                        'url': '%s/%s/%s' % ('acquisitions', aid, 'file'),
-                        'payload': {
-                            'type': type_,
-                            'state': state_,
-                            'kinds': kinds_,
-                        },
-                    }
-                ],
-                'outputs': [{'url': output_url, 'payload': i} for i in app['outputs']],
-                'status': 'pending',
-                'activity': None,
-                'added': datetime.datetime.now(),
-                'timestamp': datetime.datetime.now(),
+            'exam': session.get('exam'),
+            'app': {
+                '_id': app['_id'],
+                'type': 'docker',
             },
-            upsert=True,
-            new=True,
-        )
+            'inputs': [
+                {
+                    'filename': fileinfo['filename'],
+                    'url': '%s/%s/%s' % ('acquisitions', aid, 'file'),
+                    'payload': {
+                        'type': type_,
+                        'state': state_,
+                        'kinds': kinds_,
+                    },
+                }
+            ],
+            'outputs': [{'url': output_url, 'payload': i} for i in app['outputs']],
+            'status': 'pending',
+            'priority': 0,
+            'created': datetime.datetime.utcnow(),
+            'activity': None,
+            'added': datetime.datetime.now(),
+            'timestamp': datetime.datetime.now(),
+        }
+        try:
+            db.jobs.insert_one(job)
+        except pymongo.errors.DuplicateKeyError: # counter behind existing jobs, i.e. not seeded by dbinit
+            seed_job_counter(db)
+            job['_id'] = next_sequence(db, 'jobs')
+            db.jobs.insert_one(job)
+        db.job_events.insert_one({'job': job['_id'], 'timestamp': job['created']}) # wakes up long-polling processors, see Jobs.next
         log.info('created job %d, group: %s, project %s' % (job['_id'], job['group'], job['project']))
 
 
-def insert_app(db, fp, apps_path, app_meta=None):
+def insert_app(db, fp, apps_path, app_meta=None, sha1=None):
     """Validate and insert an application tar into the filesystem and database."""
     # download, md-5 check, and json validation are handled elsewhere
     if not app_meta:
@@ -263,11 +660,100 @@ def insert_app(db, fp, apps_path, app_meta=None):
         os.makedirs(app_dir)
     app_tar = os.path.join(app_dir, '%s-%s.tar' % (name, version))
 
-    app_meta.update({'asset_url': 'apps/%s' % app_meta.get('_id')})
+    app_meta.update({'asset_url': 'apps/%s' % app_meta.get('_id'), 'sha1': sha1 or hash_file(fp)})
     db.apps.update({'_id': app_meta.get('_id')}, app_meta, upsert=True)
+    bump_generation(db, 'apps')
     shutil.move(fp, app_tar)
 
 
+def hash_file(filepath):
+    """Return the SHA-1 of a file."""
+    hash_ = hashlib.sha1()
+    with open(filepath, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(2**20), ''):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def parse_byte_range(header, size):
+    """
+    Parse a Range header for a resource of size bytes; return (start, stop), with stop exclusive.
+
+    Returns None without a header, or for forms that may be ignored by serving the whole
+    resource (malformed, multiple ranges). Raises ValueError if the range is unsatisfiable.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if not first: # suffix range: the last bytes
+            start, stop = max(size - int(last), 0), size
+        else:
+            start, stop = int(first), min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None
+    if start >= size or start >= stop:
+        raise ValueError('range not satisfiable')
+    return start, stop
+
+
+def iter_file_range(filepath, start, stop, chunk_size=2**20):
+    """Yield the bytes [start, stop) of a file."""
+    with open(filepath, 'rb') as fd:
+        fd.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = fd.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def newest_mtime(path):
+    """Return the latest mtime of a file, or of a directory and everything below it."""
+    mtime = os.path.getmtime(path)
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fn in dirnames + filenames:
+            try:
+                mtime = max(mtime, os.path.getmtime(os.path.join(dirpath, fn)))
+            except OSError: # removed concurrently
+                pass
+    return mtime
+
+
+_boot_time = None
+
+def process_start_time(pid):
+    """Return when a process started, in seconds since the epoch; None if unknown, e.g. without /proc."""
+    global _boot_time
+    try:
+        if _boot_time is None:
+            with open('/proc/stat') as fd:
+                _boot_time = int([line.split()[1] for line in fd if line.startswith('btime')][0])
+        with open('/proc/%d/stat' % pid) as fd:
+            ticks = int(fd.read().rsplit(')', 1)[1].split()[19]) # starttime, after the parenthesized command
+    except (IOError, IndexError, ValueError):
+        return None
+    return _boot_time + ticks / float(os.sysconf('SC_CLK_TCK'))
+
+
+def pid_alive(pid, since=None):
+    """
+    Return whether process pid exists and, with since (seconds since the epoch), whether
+    it was already running then, i.e. it is not a later process that reused the pid.
+    """
+    if since is not None:
+        started = process_start_time(pid)
+        if started is not None:
+            return started <= since + 1 # btime has a resolution of one second
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
 def hrsize(size):
     if size < 1000:
         return '%d%s' % (size, 'B')
@@ -304,10 +790,12 @@ def upload_ticket(**kwargs):
     return ticket
 
 
-def download_ticket(type_, target, filename, size):
+def download_ticket(type_, target, filename, size, lifetime=60):
+    now = datetime.datetime.utcnow()
     return {
             '_id': str(uuid.uuid4()),
-            'timestamp': datetime.datetime.utcnow(),
+            'timestamp': now,
+            'expires': now + datetime.timedelta(seconds=lifetime),
             'type': type_,
             'target': target,
             'filename': filename,
@@ -330,6 +818,130 @@ def receive_stream_and_validate(stream, filepath, received_md5):
     return (md5.hexdigest() == received_md5) if received_md5 is not None else True, sha1.hexdigest(), filesize, duration
 
 
+def write_at_offset(src_path, filepath, offset):
+    """Copy a file into an existing file at offset."""
+    with open(src_path, 'rb') as src, open(filepath, 'r+b') as fd:
+        fd.seek(offset)
+        shutil.copyfileobj(src, fd, 2**20)
+
+
+def merge_ranges(ranges):
+    """Merge overlapping or adjacent [start, end) ranges into a sorted list."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class _HashingFile(object):
+
+    """Write-only file that computes the SHA-1 of everything written to it."""
+
+    def __init__(self, filepath):
+        self._fd = open(filepath, 'wb')
+        self._sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self._sha1.update(data)
+        self._fd.write(data)
+
+    def flush(self):
+        self._fd.flush()
+
+    def close(self):
+        self._fd.close()
+
+    def hexdigest(self):
+        return self._sha1.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, tb):
+        self.close()
+
+
+def _deflate_block(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _ParallelGzipFile(_HashingFile):
+
+    """
+    Write-only gzip file that deflates blocks in parallel, like pigz.
+
+    Each block is compressed independently and ends on a byte boundary (sync flush),
+    so the concatenated blocks form a single valid deflate stream. zlib releases the
+    GIL while compressing, so a thread pool spreads the work across cores.
+    """
+
+    BLOCKSIZE = 2**20
+
+    def __init__(self, filepath, level=6, threads=None):
+        super(_ParallelGzipFile, self).__init__(filepath)
+        self._level = level
+        self._threads = threads or multiprocessing.cpu_count()
+        self._pool = multiprocessing.pool.ThreadPool(self._threads)
+        self._pending = []
+        self._buffer = []
+        self._buffered = 0
+        self._crc = 0
+        self._size = 0
+        super(_ParallelGzipFile, self).write('\x1f\x8b\x08\x00' + struct.pack('<I', 0) + '\x00\xff') # no name, no mtime, unknown OS
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.BLOCKSIZE:
+            self._submit(False)
+
+    def _submit(self, last):
+        block = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._pending.append(self._pool.apply_async(_deflate_block, (block, self._level, last)))
+        while len(self._pending) > 2 * self._threads or (last and self._pending): # bound memory use, preserve block order
+            super(_ParallelGzipFile, self).write(self._pending.pop(0).get())
+
+    def close(self):
+        if self._pool is not None:
+            self._submit(True)
+            super(_ParallelGzipFile, self).write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+            self._pool.close()
+            self._pool = None
+        super(_ParallelGzipFile, self).close()
+
+    def __exit__(self, exc, value, tb):
+        if exc is not None: # do not finalize an incomplete archive
+            self._pool.terminate()
+            self._pool = None
+        self.close()
+
+
+def compressed_writer(filepath, codec='gzip', level=6, threads=None):
+    """
+    Open a write-only archive file with the given codec ('gzip' or 'none').
+
+    Completed uploads are parsed, downloaded and processed as tar files, so only codecs
+    that Python 2's tarfile reads transparently are offered.
+
+    The returned file computes the SHA-1 of the compressed output while it is written,
+    available from hexdigest() after closing.
+    """
+    if codec == 'gzip':
+        return _ParallelGzipFile(filepath, level, threads)
+    elif codec == 'none':
+        return _HashingFile(filepath)
+    else:
+        raise ValueError('unknown codec ' + codec)
+
+
 def guess_mimetype(filepath):
     """Guess MIME type based on filename."""
     mime, _ = mimetypes.guess_type(filepath)